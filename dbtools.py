@@ -11,7 +11,7 @@ def test(db):
         result = cur.fetchall()
         if result:
             result = [item[0] for item in result]
-            log(" %s Tables found in schema 'public'." % len(result))
+            log(" %s Tables found in schema 'public'.", len(result))
             err = False
             if not "planet_osm_ways" in result:
                 log("Missing table planet_osm_ways")
@@ -75,7 +75,7 @@ if __name__ == "__main__":
             #TODO will want to create function to apply diffs, will be much faster than re downloading database
             log("Subcommand applydiff is not yet implemented")
         else:
-            log("Subcommand %s not recognized. Try 'test', 'create', 'populate [FILE]', 'applydiff [FILE]'" % subcommand)
+            log("Subcommand %s not recognized. Try 'test', 'create', 'populate [FILE]', 'applydiff [FILE]'", subcommand)
     except ImportError as e:
         log("Error importing dbconfig.py, is it properly installed?", stacktrace=True)
 
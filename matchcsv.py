@@ -6,7 +6,8 @@ import time
 import pyosmroute as pyosm
 
 
-def matchcsv(csvfiles, matchargs, dbargs=None, outpoints=False, outsegs=False, outlines=False):
+def matchcsv(csvfiles, matchargs, dbargs=None, outpoints=False, outsegs=False, outlines=False, repeats=1,
+             db=None):
     """
     Do matching on a list of CSV files.
 
@@ -15,18 +16,22 @@ def matchcsv(csvfiles, matchargs, dbargs=None, outpoints=False, outsegs=False, o
     :param dbargs: The **kwargs to pass to get_planet_db()
     :param outpoints: True if points output should be written to FILE_osmpoints.csv
     :param outsegs: True if segments output should be written to FILE_osmsegs.csv
+    :param repeats: The number of times to match each file (useful for speed tests). Each file is only read once.
+    :param db: A connected PlanetDB to use instead of connecting (and disconnecting) using dbargs.
     :return: A list of dicts that are the 'stats' output of osmmatch().
     """
 
-    if dbargs is None:
-        dbargs = {}
-    db = pyosm.get_planet_db(**dbargs)
-    if not db.connect():
-        pyosm.log("Error connecting to database!")
-        return []
+    owndb = db is None
+    if owndb:
+        if dbargs is None:
+            dbargs = {}
+        db = pyosm.get_planet_db(**dbargs)
+        if not db.connect():
+            pyosm.log("Error connecting to database!")
+            return []
     allstats = []
     for csvfile in csvfiles:
-        pyosm.log("Processing CSV: %s" % csvfile)
+        pyosm.log("Processing CSV: %s", csvfile)
         try:
             with open(csvfile) as f:
                 firstline = f.readline()
@@ -34,24 +39,59 @@ def matchcsv(csvfiles, matchargs, dbargs=None, outpoints=False, outsegs=False, o
                     headers = True
                 else: # is a chris processed trip
                     headers = False
-            df = pyosm.read_csv(csvfile, driver="csv", headers=headers, skiprows=1)
-            stats, points, segs = pyosm.osmmatch(db, df, lon_column=2, lat_column=1, unparsed_datetime_col=0)
-            stats["_csv_file"] = csvfile
-            allstats.append(stats)
-            if outpoints and points:
-                points.to_csv(csvfile[:-4] + "_osmpoints.csv")
-            if outsegs and segs:
-                segs.to_csv(csvfile[:-4] + "_osmsegs.csv")
-            if outlines:
-                with open(csvfile[:-4] + "_osmlines.json", "w") as f:
-                    json.dump(pyosm.make_linestring(segs), f)
+                # first line is already consumed, and only date/time, latitude, and longitude are used
+                df = pyosm.read_csv(f, driver="csv", headers=headers, usecols=(0, 1, 2))
+            for i in range(repeats):
+                # osmmatch() adds columns to the DataFrame, so give each repeat a fresh copy
+                stats, points, segs = pyosm.osmmatch(db, df.copy(), lon_column=2, lat_column=1,
+                                                     unparsed_datetime_col=0)
+                stats["_csv_file"] = csvfile
+                allstats.append(stats)
+                if outpoints and points:
+                    points.to_csv(csvfile[:-4] + "_osmpoints.csv")
+                if outsegs and segs:
+                    segs.to_csv(csvfile[:-4] + "_osmsegs.csv")
+                if outlines:
+                    with open(csvfile[:-4] + "_osmlines.json", "w") as f:
+                        json.dump(pyosm.make_linestring(segs), f)
         except Exception as e:
-            pyosm.log("Could not process trip %s: %s" % (csvfile, e), stacktrace=True)
+            pyosm.log("Could not process trip %s: %s", csvfile, e, stacktrace=True)
             allstats.append({'_csv_file': csvfile, 'result': type(e).__name__})
-    db.disconnect() # already taken care of by context manager, but might as well
+    if owndb:
+        db.disconnect() # already taken care of by context manager, but might as well
     return allstats
 
 
+def _findcsvs(directory, recursive=False):
+    # os.scandir gives file types without a separate stat() call for each entry
+    dirs = [directory, ]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                # symlinked directories are not followed (as with os.walk()), so a link cycle can't loop forever
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        dirs.append(entry.path)
+                elif entry.name.endswith(".csv"):
+                    yield entry.path
+
+
+# each pool worker connects once in _initworker() and keeps the connection for all of its chunks
+_workerdb = None
+
+
+def _initworker(dbargs):
+    global _workerdb
+    db = pyosm.get_planet_db(**dbargs)
+    # on failure, matchcsv() will try to connect itself and log the error
+    _workerdb = db if db.connect() else None
+
+
+def _matchchunk(args):
+    # Pool.imap_unordered passes a single argument
+    return matchcsv(*args, db=_workerdb)
+
+
 if __name__ == "__main__":
     # designed to be run from the command line. folder is main argument, walked recursively if -r is passed
     # output file as -o [FILE]
@@ -85,22 +125,11 @@ if __name__ == "__main__":
 
     csvfiles = []
     if os.path.isfile(args.infile):
-        csvfiles = [args.infile for i in range(args.n)]
+        csvfiles = [args.infile, ]
     elif os.path.isdir(args.infile):
-        if args.recursive:
-            for root, dirs, files in os.walk(args.infile):
-                for file in files:
-                    if file.endswith(".csv"):
-                        for i in range(args.n):
-                            csvfiles.append(os.path.join(root, file))
-        else:
-            for file in os.listdir(args.infile):
-                if file.endswith(".csv"):
-                    for i in range(args.n):
-                        csvfiles.append(os.path.join(args.infile, file))
-
+        csvfiles = list(_findcsvs(args.infile, recursive=args.recursive))
     else:
-        pyosm.log("%s is not a file or directory" % args.infile)
+        pyosm.log("%s is not a file or directory", args.infile)
         sys.exit(1)
 
     if not csvfiles:
@@ -113,29 +142,35 @@ if __name__ == "__main__":
         try:
             matchargs = json.loads(args.matchargs.replace("'", '"'))
         except ValueError as e:
-            pyosm.log("Invalid matchargs string: %s (%s)" % (args.matchargs, e))
+            pyosm.log("Invalid matchargs string: %s (%s)", args.matchargs, e)
             sys.exit(2)
     dbargs = {} # add these to commandline someday?
 
     tstart = time.time()
 
     if args.processes > 1 and args.chunksize <= len(csvfiles):
-        from multiprocessing import Pool
+        import multiprocessing
+        # forked workers start without re-importing everything (spawn is the only option on windows)
+        ctx = multiprocessing.get_context("spawn" if sys.platform == "win32" else "fork")
         csvchunks  = [csvfiles[i:i+args.chunksize] for i in range(0, len(csvfiles), args.chunksize)]
-        processargs = [(chunk, matchargs, dbargs, args.writepoints, args.writesegs, args.writelines) for chunk in csvchunks]
-        with Pool(args.processes) as p:
-            res = list(p.starmap(matchcsv, processargs))
-            res = [item for sublist in res for item in sublist]
-            summary = pyosm.DataFrame.from_dict_list(res, no_value="", keys=args.outcols)
+        processargs = [(chunk, matchargs, dbargs, args.writepoints, args.writesegs, args.writelines, args.n)
+                       for chunk in csvchunks]
+        res = []
+        with ctx.Pool(args.processes, initializer=_initworker, initargs=(dbargs, )) as p:
+            # collect each chunk as soon as it is done rather than waiting for all of them
+            for chunkstats in p.imap_unordered(_matchchunk, processargs):
+                res.extend(chunkstats)
+        summary = pyosm.DataFrame.from_dict_list(res, no_value="", keys=args.outcols)
     else:
         summary = pyosm.DataFrame.from_dict_list(matchcsv(csvfiles, matchargs, dbargs,
-                                                          args.writepoints, args.writesegs, args.writelines),
+                                                          args.writepoints, args.writesegs, args.writelines,
+                                                          args.n),
                                                  no_value="",
                                                  keys=args.outcols)
 
     telapsed = time.time() - tstart
-    pyosm.log("Matched %s trips in %0.1f secs (%0.1f secs / trip)" % (len(csvfiles),
-                                                                      telapsed, telapsed / len(csvfiles)))
+    ntrips = len(csvfiles) * args.n
+    pyosm.log("Matched %s trips in %0.1f secs (%0.1f secs / trip)", ntrips, telapsed, telapsed / ntrips)
 
     if args.output:
         summary.to_csv(args.output)
@@ -1,6 +1,6 @@
 
 from .osm.mapmatch import osmmatch, nearest_road, make_linestring
-from .utils import get_planet_db, on_road
+from .utils import get_planet_db, on_road, on_road_percent
 from .logger import log, config_logger
 from .dataframe import DataFrame, read_csv
 from .gpsclean import cleanpoints
@@ -2,24 +2,37 @@
 import numpy as np
 import csv
 import decimal
+import re
 from .logger import log
 
 
+_SEQUENCE_TYPES = (list, tuple, np.ndarray, set)
+# np.int was removed from numpy, np.integer and np.floating cover all of the sized numpy types
+_NUMERIC_TYPES = (int, float, np.integer, np.floating, decimal.Decimal)
+# everything int() or float() can parse matches this (and some things neither can), so text that doesn't match
+# can be kept without raising and catching two exceptions
+_NUMBER_RE = re.compile(r"\s*[-+]?(\d[\d_]*\.?[\d_]*|\.\d[\d_]*|nan|inf(inity)?)([eE][-+]?\d[\d_]*)?\s*\Z",
+                        re.IGNORECASE)
+
+
 def _len(obj):
-    if type(obj) in (list, tuple, np.ndarray, set):
+    if isinstance(obj, _SEQUENCE_TYPES):
         return len(obj)
     else:
         return 1
 
 
 def _aslist(obj):
-    if type(obj) in (list, tuple, np.ndarray, set):
+    if isinstance(obj, _SEQUENCE_TYPES):
         return obj
     else:
         return [obj, ]
 
+
 def _asnumeric(obj):
-    if type(obj) in (int, float, np.int, np.int64, np.int8, np.int16, np.int32, decimal.Decimal):
+    if isinstance(obj, _NUMERIC_TYPES):
+        return obj
+    if isinstance(obj, str) and not _NUMBER_RE.match(obj):
         return obj
     try:
         return int(obj)
@@ -34,31 +47,81 @@ def _asnumeric(obj):
     return obj
 
 
-class _DFRow(dict):
+def _isnumeric_array(column):
+    return isinstance(column, np.ndarray) and column.dtype.kind in "biuf"
+
+
+def _asnumeric_column(values):
+    # converting a whole column of strings at once is much faster than calling _asnumeric() on each value,
+    # which is only needed if the column is a mix of numbers and text
+    if not values:
+        return values
+    strings = np.array(values)
+    try:
+        return strings.astype(np.int64)
+    except ValueError:
+        try:
+            return strings.astype(np.float64)
+        except ValueError:
+            pass
+    except OverflowError:
+        # integers too big for int64 are kept as python ints
+        pass
+    return [_asnumeric(c) for c in values]
+
+
+class _DFRow(object):
+    # a lightweight row view: all rows of a DataFrame share one {name: position} index, so each row only
+    # allocates its tuple of values rather than a whole dict
+    __slots__ = ("_idx", "_vals")
 
-    def __init__(self, columns, vals):
-        super(_DFRow, self).__init__(zip(columns, vals))
-        self._keys = tuple(columns)
+    def __init__(self, index, vals):
+        self._idx = index
+        self._vals = tuple(vals)
 
     def __getitem__(self, item):
-        if item in self:
-            return super(_DFRow, self).__getitem__(item)
-        else:
+        try:
+            return self._vals[self._idx[item]]
+        except (KeyError, TypeError):
             try:
-                return super(_DFRow, self).__getitem__(self._keys[item])
-            except IndexError:
+                return self._vals[item]
+            except (IndexError, TypeError):
                 raise KeyError("So such key in row")
 
+    def get(self, key, default=None):
+        i = self._idx.get(key)
+        return default if i is None else self._vals[i]
+
+    def __contains__(self, key):
+        return key in self._idx
+
+    def __len__(self):
+        return len(self._vals)
+
     def __iter__(self):
-        for key in self._keys:
-            yield self[key]
+        return iter(self._vals)
 
     def keys(self):
-        return self._keys
+        return tuple(self._idx)
+
+    def values(self):
+        return self._vals
 
     def items(self):
-        for key in self._keys:
-            yield key, self[key]
+        return zip(self._idx, self._vals)
+
+    def __eq__(self, other):
+        return dict(self.items()) == (dict(other.items()) if isinstance(other, _DFRow) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def _rowindex(keys):
+    return dict((key, i) for i, key in enumerate(keys))
 
 
 class _Iloc(object):
@@ -96,6 +159,9 @@ class DataFrame(object):
         :return:
         """
         self.__rows = None
+        # columns are kept apart from the object's attributes, by name in the order of self.__keynames
+        self.__columns = {}
+        self.__buffers = {}
         if "columns" in kwargs:
             columns = kwargs['columns']
             del kwargs['columns']
@@ -114,6 +180,8 @@ class DataFrame(object):
             columns = [self.__default_arg_name(i) for i in range(len(args))]
 
         self.__keynames = []
+        self.__rowindex = None
+        self.__columnnames = None
         for i in range(len(args)):
             self.__setitem__(columns[i], args[i])
         for key, value in kwargs.items():
@@ -124,11 +192,22 @@ class DataFrame(object):
     def __default_arg_name(self, index):
         return "V%02d" % index
 
+    @classmethod
+    def _from_columns(cls, columns, arrays):
+        # wraps existing column arrays without the length checks and np.array() copy done by __setitem__
+        df = cls()
+        for key, array in zip(columns, arrays):
+            df.__columns[key] = array
+            df.__keynames.append(key)
+        if arrays:
+            df.__rows = len(arrays[0])
+        return df
+
     def copy(self):
         """
         :return: A shallow copy of the DataFrame (underlying ndarras are not copied)
         """
-        return DataFrame(*[self[col] for col in self], columns=self.__keynames)
+        return DataFrame._from_columns(self.__keynames, [self.__columns[key] for key in self.__keynames])
 
     def ncol(self):
         """
@@ -138,9 +217,13 @@ class DataFrame(object):
 
     def columns(self):
         """
-        :return: The columns. Probably shouldn't use this as it isn't a part of pandas.DataFrame
+        :return: The columns (a read-only array). Probably shouldn't use this as it isn't a part of pandas.DataFrame
         """
-        return np.array(self.__keynames)
+        # cached until columns are added or removed, read-only because the same array is returned each time
+        if self.__columnnames is None:
+            self.__columnnames = np.array(self.__keynames)
+            self.__columnnames.flags.writeable = False
+        return self.__columnnames
 
     def _subset(self, rows, cols):
         if type(cols) == slice:
@@ -153,30 +236,47 @@ class DataFrame(object):
             raise KeyError("One of the following is not a valid column: %s" % (cols, ))
         if type(rows) == tuple:
             rows = list(rows)
-        return DataFrame(*[_aslist(self[col][rows]) for col in icols], columns=icols)
+        arrays = [self.__columns[key][rows] for key in icols]
+        if len(set(icols)) == len(icols) and all(isinstance(array, np.ndarray) for array in arrays):
+            # indexing already gave new arrays (or views, for a slice of rows), no need to copy them again
+            return DataFrame._from_columns(icols, arrays)
+        return DataFrame(*[_aslist(array) for array in arrays], columns=icols)
 
     def _row(self, i):
-        return _DFRow(self.__keynames, [self[col][i] for col in self])
+        if self.__rowindex is None:
+            self.__rowindex = _rowindex(self.__keynames)
+        return _DFRow(self.__rowindex, [self.__columns[key][i] for key in self.__keynames])
 
-    def itertuples(self, header=False, rownames=True):
+    def itertuples(self, header=False, rownames=True, raw=False):
         """
         An iterator that iterates over rows.
 
         :param header: True if the header should be inclued in the iterations.
         :param rownames: True if rownames should be inclued in the rows returned.
-        :return: Each row is basically an ordered dictionary that can be indexed by name or position.
+        :param raw: True if rows should be plain tuples, which is much faster when rows are only iterated over.
+        :return: Each row is basically an ordered dictionary that can be indexed by name or position (or a tuple
+                 if raw is True).
         """
         if header:
             if rownames:
                 yield [-1, ] + self.__keynames
             else:
                 yield list(self.__keynames)
-        if rownames:
-            for i in range(len(self)):
-                yield _DFRow(["_index", ] + self.__keynames, [i, ] + [self[col][i] for col in self])
+        if raw:
+            columns = [self.__columns[key] for key in self.__keynames]
+            if rownames:
+                columns.insert(0, range(len(self)))
+            for row in zip(*columns):
+                yield row
         else:
-            for i in range(len(self)):
-                yield _DFRow(self.__keynames, [self[col][i] for col in self])
+            columns = [self.__columns[key] for key in self.__keynames]
+            if rownames:
+                index = _rowindex(["_index", ] + self.__keynames)
+                columns.insert(0, range(len(self)))
+            else:
+                index = _rowindex(self.__keynames)
+            for row in zip(*columns):
+                yield _DFRow(index, row)
 
     def __iter__(self):
         return iter(self.__keynames)
@@ -185,28 +285,36 @@ class DataFrame(object):
         return reversed(self.__keynames)
 
     def __contains__(self, item):
-        return item in self.__keynames
+        try:
+            return item in self.__columns
+        except TypeError:
+            return False
 
     def __len__(self):
         return 0 if self.__rows is None else self.__rows
 
     def __internal_key(self, keyin):
-        if keyin in self.__keynames:
-            return keyin
-        else:
-            try:
-                if keyin < len(self.__keynames):
-                    return self.__keynames[keyin]
-            except (TypeError, IndexError):
-                return None
+        # self.__columns is keyed by name, so names are found without scanning self.__keynames
+        try:
+            if keyin in self.__columns:
+                return keyin
+        except TypeError:
+            return None
+        try:
+            if keyin < len(self.__keynames):
+                return self.__keynames[keyin]
+        except (TypeError, IndexError):
+            return None
 
     def __delitem__(self, orig):
         key = self.__internal_key(orig)
         if key is None:
             raise KeyError("No such column: %s" % orig)
-        del self.__dict__[key]
-        if key in self.__keynames:
-            self.__keynames.remove(key)
+        del self.__columns[key]
+        self.__buffers.pop(key, None)
+        self.__keynames.remove(key)
+        self.__rowindex = None
+        self.__columnnames = None
 
     def __setitem__(self, orig, value, check=True):
         key = self.__internal_key(orig)
@@ -219,28 +327,32 @@ class DataFrame(object):
                 raise ValueError("Number of observations is not consistent (%s, %s) for arg %s" % (self.__rows,
                                                                                                   len(value),
                                                                                                     key))
+        if key not in self.__columns:
+            self.__keynames.append(key)
+            self.__rowindex = None
+            self.__columnnames = None
         try:
-            self.__dict__[key] = np.array(value)
+            self.__columns[key] = np.array(value)
         except ValueError:
             # raised by pypy's numpy, which doesn't like lists within arrays
-            self.__dict__[key] = value
-        if key not in self.__keynames:
-            self.__keynames.append(key)
+            self.__columns[key] = value
+        self.__buffers.pop(key, None)
 
     def __getattr__(self, item):
-        if item in self.__keynames:
-            key = self.__internal_key(item)
-            if key is None:
-                raise KeyError("No such column: %s" % item)
-            return self.__dict__[key]
-        else:
+        if item.startswith("_DataFrame__"):
+            # not yet set (e.g. while unpickling), checking self.__columns here would recurse
+            raise AttributeError(item)
+        # only called once normal attribute lookup has failed, so a column is one dict lookup away
+        try:
+            return self.__columns[item]
+        except KeyError:
             return super(DataFrame, self).__getattribute__(item)
 
     def __getitem__(self, item):
         key = self.__internal_key(item)
         if key is None:
             raise KeyError("No such column: %s" % item)
-        return self.__dict__[key]
+        return self.__columns[key]
 
     def insert(self, index, *args, **kwargs):
         """
@@ -265,17 +377,11 @@ class DataFrame(object):
             key = self.__internal_key(i)
             if key is None:
                 raise KeyError("No such column: ", i)
-            try:  # this is to maintain pypy numpy compatibility, or ValueError is raised when tuples are the elements
-                self.__dict__[key] = np.array(list(self[key][:index]) + [args[i],] + list(self[key][index:]))
-            except ValueError:
-                self.__dict__[key] = list(self[key][:index]) + [args[i],] + list(self[key][index:])
+            self.__insert_column(key, index, args[i])
         for key, value in kwargs.items():
             if key not in self:
                 raise KeyError("No such column: ", key)
-            try:  # this is to maintain pypy numpy compatibility, or ValueError is raised when tuples are the elements
-                self.__dict__[key] = np.array(list(self[key][:index]) + [value,] + list(self[key][index:]))
-            except ValueError:
-                self.__dict__[key] = list(self[key][:index]) + [value,] + list(self[key][index:])
+            self.__insert_column(key, index, value)
         self.__rows += newrows
 
     def append(self, *args, **kwargs):
@@ -304,18 +410,59 @@ class DataFrame(object):
             key = self.__internal_key(i)
             if key is None:
                 raise KeyError("No such column: ", i)
-            self.__dict__[key] = np.append(self[key], args[i])
+            self.__append_column(key, args[i], newrows)
         for key, value in kwargs.items():
             if key not in self:
                 raise KeyError("No such column: ", key)
-            self.__dict__[key] = np.append(self[key], value)
+            self.__append_column(key, value, newrows)
         self.__rows += newrows
 
+    def __insert_column(self, key, index, value):
+        self.__buffers.pop(key, None)
+        column = self.__columns[key]
+        if isinstance(column, np.ndarray) and column.ndim == 1 and len(column) and np.ndim(value) == 0:
+            # splice scalars in without boxing every element of the column into a list
+            try:
+                self.__columns[key] = np.concatenate((column[:index], np.array([value]), column[index:]))
+                return
+            except (TypeError, ValueError):
+                pass
+        try:  # this is to maintain pypy numpy compatibility, or ValueError is raised when tuples are the elements
+            self.__columns[key] = np.array(list(column[:index]) + [value, ] + list(column[index:]))
+        except ValueError:
+            self.__columns[key] = list(column[:index]) + [value, ] + list(column[index:])
+
+    def __append_column(self, key, value, newrows):
+        # columns are views of a buffer with spare capacity, so appending one row at a time doesn't copy the
+        # whole column each time
+        column = self.__columns[key]
+        value = np.ravel(value)
+        if not isinstance(column, np.ndarray) or len(value) != newrows:
+            self.__buffers.pop(key, None)
+            self.__columns[key] = np.append(column, value)
+            return
+        rows = len(column)
+        dtype = np.result_type(column, value)
+        buf = self.__buffers.get(key)
+        if buf is None or buf.dtype != dtype or len(buf) < rows + newrows:
+            buf = np.empty(max(2 * (rows + newrows), 8), dtype=dtype)
+            buf[:rows] = column
+            self.__buffers[key] = buf
+        buf[rows:rows + newrows] = value
+        self.__columns[key] = buf[:rows + newrows]
+
     def __bool__(self):
         return self.__rows is not None and self.__rows > 0
 
+    def __strcolumns(self):
+        # str() of every cell, by column. numpy formats numeric columns in C, giving the same text as str()
+        return [self.__columns[key].astype(str) if _isnumeric_array(self.__columns[key])
+                else [str(cell) for cell in self.__columns[key]] for key in self.__keynames]
+
     def __repr__(self, sep="\t"):
-        return "\n".join(sep.join(str(cell) for cell in row) for row in self.itertuples(header=True, rownames=False))
+        lines = [sep.join(str(key) for key in self.__keynames)]
+        lines.extend(sep.join(row) for row in zip(*self.__strcolumns()))
+        return "\n".join(lines)
 
     def head(self, nrow=6):
         """
@@ -340,8 +487,7 @@ class DataFrame(object):
         Jupyter Notebook magic repr function.
         """
         head = '<tr>%s</tr>\n' % ''.join(['<td><strong>%s</strong></td>' % c for c in self.__keynames])
-        rows = [''.join(['<td>%s</td>' % c for c in row])
-                          for row in self.itertuples(rownames=False, header=False)]
+        rows = [''.join(['<td>%s</td>' % c for c in row]) for row in zip(*self.__strcolumns())]
         html = '<table>{}</table>'.format(head + '\n'.join(['<tr>%s</tr>' % row for row in rows]))
         return html
 
@@ -374,16 +520,18 @@ class DataFrame(object):
 
         headers = mode == "w"
         if driver == "csv":
-            for row in self.itertuples(header=headers, rownames=False):
-                cells = [str(cell) for cell in row]
-                for i, cell in enumerate(cells):
-                    if "," in cell:
-                        cells[i] = '"%s"' % cell
-                writer.write(",".join(cells))
-                writer.write("\n")
+            # csv.writer quotes cells with commas, quotes or newlines; cells are still formatted with str() so
+            # values (e.g. None, floats) are written as before
+            csvwriter = csv.writer(writer, lineterminator="\n")
+            if headers:
+                csvwriter.writerow([str(key) for key in self.__keynames])
+            csvwriter.writerows(zip(*self.__strcolumns()))
         elif driver == "tsv":
-            for row in self.itertuples(header=headers, rownames=False):
-                writer.write("\t".join([str(cell) for cell in row]))
+            if headers:
+                writer.write("\t".join([str(key) for key in self.__keynames]))
+                writer.write("\n")
+            for row in zip(*self.__strcolumns()):
+                writer.write("\t".join(row))
                 writer.write("\n")
         elif driver == "json":
             if fname:
@@ -422,15 +570,15 @@ class DataFrame(object):
         if keys is None:
             keys = set()
             for dict in list_of_dicts:
-                keys = keys.union(set(dict.keys()))
+                keys.update(dict.keys())
             keys = list(sorted(keys))
         df = DataFrame()
         for key in keys:
-            df[key] = [d[key] if key in d else no_value for d in list_of_dicts]
+            df[key] = [d.get(key, no_value) for d in list_of_dicts]
         return df
 
 
-def read_csv(reader, driver=None, headers=True, skiprows=0, numeric=True):
+def read_csv(reader, driver=None, headers=True, skiprows=0, numeric=True, usecols=None):
     """
     Reads a file in as a DataFrame.
 
@@ -439,6 +587,7 @@ def read_csv(reader, driver=None, headers=True, skiprows=0, numeric=True):
     :param headers: True if headers should be written, false otherwise.
     :param skiprows: Skip this number of rows before reading data.
     :param numeric: True if data should be converted to numeric (if possible).
+    :param usecols: A list of column indices to keep, or None to keep all columns.
     :return: A DataFrame with the resulting data.
     """
     fname = None
@@ -468,30 +617,27 @@ def read_csv(reader, driver=None, headers=True, skiprows=0, numeric=True):
     csvreader = csv.reader(reader)
     records = []
     columns = None
+    # look for the first line with data (the header if there is one), then read the rest in one go
     for line in csvreader:
         if skiprows > 0:
             skiprows -= 1
             continue
-        if not records and not columns:
-            # look for data
-            if any([bool(c) for c in line]):
-                if headers:
-                    columns = line
-                else:
-                    if numeric:
-                        records.append([_asnumeric(c) for c in line])
-                    else:
-                        records.append(line)
+        if usecols is not None and line:
+            line = [line[i] for i in usecols]
+        if any(line):
+            records = list(csvreader)
+            if usecols is not None:
+                records = [[row[i] for i in usecols] if row else row for row in records]
+            if headers:
+                columns = line
             else:
-                # no data
-                continue
-        else:
-            # already a df
-            if numeric:
-                records.append([_asnumeric(c) for c in line])
-            else:
-                records.append(line)
+                records.insert(0, line)
+            break
     if fname:
         reader.close()
 
-    return DataFrame.from_records(records) if columns is None else DataFrame.from_records(records, columns=columns)
+    data = list(zip(*records))
+    if numeric:
+        data = [_asnumeric_column(values) for values in data]
+
+    return DataFrame(*data) if columns is None else DataFrame(*data, columns=columns)
@@ -4,7 +4,6 @@ try:
 except ImportError:
     import psycopg2cffi as psycopg2
 
-import numpy as np
 from .logger import log
 from .dataframe import DataFrame
 
@@ -13,31 +12,37 @@ class DBException(Exception):
     pass
 
 
-def _where(arg):
-    # this exists because 1-arg np.where is not supported in pypy
-    return np.array([i for i, item in enumerate(arg) if item])
-
 # functions for dealing with data out of the db
 
 
 def pairwise(iterable):
-    try:
-        itnext = iter(iterable).__next__
-    except AttributeError:
-        itnext = iter(iterable).next
-    while True:
-        yield itnext(), itnext()
+    # zipping an iterator with itself pairs up consecutive items in C (and, unlike calling next() in a
+    # generator, stops cleanly at the end under PEP 479)
+    it = iter(iterable)
+    return zip(it, it)
 
 
 def hstore_to_dict(seq):
-    if seq is not None:
-        return dict(pairwise(seq))
-    else:
+    # tags come back from osm2pgsql's tables as a flat [key1, value1, key2, value2, ...] list
+    if seq is None:
         return {}
+    try:
+        return dict(zip(seq[::2], seq[1::2]))
+    except TypeError:
+        # not sliceable (e.g. a generator)
+        return dict(pairwise(seq))
 
 
-def bycol(cursor):
-    return zip(*cursor.fetchall())
+def bycol(cursor, batchsize=10000):
+    # columns are filled a batch at a time, so the whole result is never also held as a list of row tuples
+    # (with a named, server-side cursor rows are streamed from the server as well)
+    columns = None
+    for batch in iter(lambda: cursor.fetchmany(batchsize), []):
+        if columns is None:
+            columns = [[] for value in batch[0]]
+        for j, column in enumerate(columns):
+            column.extend(row[j] for row in batch)
+    return columns if columns is not None else [[] for c in cursor.description]
 
 
 def byrow(cursor):
@@ -45,13 +50,14 @@ def byrow(cursor):
 
 
 def asdataframe(cursor):
-    columns = [str(c[0]) for c in cursor.description]
-    hstoreind = _where("tags" == np.array(columns))
+    # a named cursor has no description until the first rows are fetched
     data = bycol(cursor)
-    df = DataFrame(*data, columns=columns)
-    for i in hstoreind:
-        df[i] = [hstore_to_dict(item) for item in df[i]]
-    return df
+    columns = [str(c[0]) for c in cursor.description]
+    for i, column in enumerate(columns):
+        if column == "tags":
+            # converted before the DataFrame is made, so the raw tag lists never go through np.array()
+            data[i] = [hstore_to_dict(item) for item in data[i]]
+    return DataFrame(*data, columns=columns)
 
 
 class GenericDB(object):
@@ -59,6 +65,9 @@ class GenericDB(object):
     A generic Postgres DB wrapper, returning cursor results as a DataFrame.
     """
 
+    # PREPARE statements run once on each new connection, for queries that subclasses execute many times
+    prepared_statements = ()
+
     def __init__(self, host, username, password, dbname):
         self.host = host
         self.username = username
@@ -85,23 +94,37 @@ class GenericDB(object):
         """
         if self.conn:
             return True
-        log("Connecting to %s" % repr(self))
+        log("Connecting to %r", self)
         try:
             self.conn = psycopg2.connect(host=self.host, user=self.username, password=self.password,
                                          database=self.dbname)
-            return True
         except:
             log("error connecting to Postgre database", stacktrace=True)
             return False
-
-    def cursor(self):
+        if self.prepared_statements:
+            try:
+                with self.conn.cursor() as cur:
+                    for statement in self.prepared_statements:
+                        cur.execute(statement)
+                self.conn.commit()
+            except psycopg2.Error:
+                # e.g. a table is missing: don't keep a connection whose transaction has aborted
+                log("error preparing statements for %r", self, stacktrace=True)
+                self.conn.close()
+                self.conn = None
+                return False
+        return True
+
+    def cursor(self, name=None):
         """
         Get a new cursor from self.conn
 
+        :param name: Pass a name to get a server-side cursor, which streams large results instead of
+                     transferring all rows on execute().
         :return: A psycopg2 Cursor object.
         """
         if self.conn:
-            return self.conn.cursor()
+            return self.conn.cursor(name) if name is not None else self.conn.cursor()
         else:
             raise DBException("Attempted to create cursor from disconnected database")
 
@@ -114,7 +137,7 @@ class GenericDB(object):
         if self.conn:
             self.conn.close()
             self.conn = None
-            log("Disconnected from database: %s" % repr(self))
+            log("Disconnected from database: %r", self)
             return True
         else:
             log("Failed to disconnect from database: self.conn is None")
@@ -1,6 +1,8 @@
 
 from math import sin, cos, atan2, sqrt, radians, degrees, acos, asin, log, pi, atan, exp, tan
 
+import numpy as np
+
 
 def _radius(p1, p2, ellipsoid):
     if ellipsoid is not None:
@@ -14,47 +16,128 @@ def geodist(origin, destination, ellipsoid=None, wraplat=True):
     lon1, lat1 = origin
     lon2, lat2 = destination
 
+    # no need to wrap dlondeg across the antimeridian (wraplat): sin(dlon/2) is only used squared, so a
+    # difference of 360 degrees changes nothing
     dlatdeg = lat2-lat1
     dlondeg = lon2-lon1
-    if wraplat:
-        if dlondeg > 180:
-            dlondeg = 360 - dlondeg
-        elif dlondeg < -180:
-            dlondeg = -360 - dlondeg
-
-    dlat = radians(dlatdeg)
-    dlon = radians(dlondeg)
-    a = sin(dlat/2) * sin(dlat/2) + cos(radians(lat1)) \
-        * cos(radians(lat2)) * sin(dlon/2) * sin(dlon/2)
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
+
+    # each sine is only evaluated once, this is called for every pair of points and every segment
+    sindlat = sin(radians(dlatdeg)/2)
+    sindlon = sin(radians(dlondeg)/2)
+    a = sindlat * sindlat + cos(radians(lat1)) \
+        * cos(radians(lat2)) * sindlon * sindlon
+    # one square root rather than the two of 2 * atan2(sqrt(a), sqrt(1-a)); min() guards against rounding above 1
+    c = 2 * asin(sqrt(min(1.0, a)))
     d = _radius(origin, destination, ellipsoid) * c
 
     return d
 
 
+def _haversine(origin, destination):
+    # the haversine of the central angle, as in geodist(). it increases with distance, so comparing it with
+    # _haversine_limit() tests whether two points are within a distance without the square root and asin
+    lon1, lat1 = origin
+    lon2, lat2 = destination
+    sindlat = sin(radians(lat2-lat1)/2)
+    sindlon = sin(radians(lon2-lon1)/2)
+    return sindlat * sindlat + cos(radians(lat1)) * cos(radians(lat2)) * sindlon * sindlon
+
+
+def _haversine_limit(distance, ellipsoid=None):
+    # the value of _haversine() for two points that are distance metres apart
+    halfangle = min(distance / (2 * _radius(None, None, ellipsoid)), pi / 2)
+    return sin(halfangle) ** 2
+
+
+def geodist_approx(origin, destination, ellipsoid=None, wraplat=True):
+    # equirectangular approximation of geodist(), with no trig other than one cosine. within a fraction of a
+    # percent of geodist() for points a few km apart away from the poles, but not for long distances
+    lon1, lat1 = origin
+    lon2, lat2 = destination
+
+    dlondeg = lon2-lon1
+    if wraplat:
+        # into [-180, 180) without branching
+        dlondeg = (dlondeg + 180) % 360 - 180
+
+    x = radians(dlondeg) * cos(radians((lat1+lat2) / 2))
+    y = radians(lat2-lat1)
+    return _radius(origin, destination, ellipsoid) * sqrt(x*x + y*y)
+
+
+def geodist_vec(lons1, lats1, lons2, lats2, ellipsoid=None, wraplat=True, coslats1=None, coslats2=None):
+    # geodist() for arrays of origin and destination coordinates. the cosines of the latitudes can be passed
+    # in when they are already known (e.g. when each point is the end of one pair and the start of the next)
+    lons1, lats1, lons2, lats2 = (np.asarray(x, dtype=np.float64) for x in (lons1, lats1, lons2, lats2))
+    if coslats1 is None:
+        coslats1 = np.cos(np.radians(lats1))
+    if coslats2 is None:
+        coslats2 = np.cos(np.radians(lats2))
+
+    # no wrapping needed, as for geodist(). for long traces the time goes into allocating a temporary array for
+    # every operation, so the same arithmetic is done in place on three buffers
+    a = np.asarray(lats2 - lats1)
+    np.radians(a, out=a)
+    a /= 2
+    np.sin(a, out=a)
+    a *= a
+    sindlon = np.asarray(lons2 - lons1)
+    np.radians(sindlon, out=sindlon)
+    sindlon /= 2
+    np.sin(sindlon, out=sindlon)
+    term = np.asarray(coslats1 * coslats2)
+    term *= sindlon
+    term *= sindlon
+    a += term
+
+    np.minimum(a, 1.0, out=a)
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2
+    a *= _radius((lons1, lats1), (lons2, lats2), ellipsoid)
+    return a[()]
+
+
 def bearing_to(origin, destination, wraplat=True):
     if origin == destination:
         return float('nan')
     lon1, lat1 = origin
     lon2, lat2 = destination
-    dlondeg = lon2-lon1
-    if wraplat:
-        if dlondeg > 180:
-            dlondeg = 360 - dlondeg
-        elif dlondeg < -180:
-            dlondeg = -360 - dlondeg
 
     lat1 = radians(lat1)
     lat2 = radians(lat2)
-    dlon = radians(dlondeg)
+    # the sine and cosine of dlon don't change if it is off by 360 degrees, so it is never wrapped (wraplat)
+    dlon = radians(lon2-lon1)
 
-    y = sin(dlon) * cos(lat2)
-    x = cos(lat1)*sin(lat2) - sin(lat1)*cos(lat2)*cos(dlon)
+    coslat2 = cos(lat2)
+    y = sin(dlon) * coslat2
+    x = cos(lat1)*sin(lat2) - sin(lat1)*coslat2*cos(dlon)
     result = degrees(atan2(y, x))
     return result if result >= 0 else result + 360
 
 
+def bearing_to_vec(lons1, lats1, lons2, lats2, wraplat=True, sinlats1=None, coslats1=None, sinlats2=None,
+                   coslats2=None):
+    # bearing_to() for arrays of origin and destination coordinates, with optional precomputed sines and
+    # cosines of the latitudes as for geodist_vec()
+    lons1, lats1, lons2, lats2 = (np.asarray(x, dtype=np.float64) for x in (lons1, lats1, lons2, lats2))
+    if sinlats1 is None or coslats1 is None:
+        sinlats1, coslats1 = np.sin(np.radians(lats1)), np.cos(np.radians(lats1))
+    if sinlats2 is None or coslats2 is None:
+        sinlats2, coslats2 = np.sin(np.radians(lats2)), np.cos(np.radians(lats2))
+
+    dlon = np.radians(lons2-lons1)
+
+    y = np.sin(dlon) * coslats2
+    x = coslats1*sinlats2 - sinlats1*coslats2*np.cos(dlon)
+    result = np.degrees(np.arctan2(y, x))
+    result = np.where(result >= 0, result, result + 360)
+    return np.where((lons1 == lons2) & (lats1 == lats2), float('nan'), result)
+
+
 def bearing_difference(bearing1, bearing2):
+    # the difference folded into [-180, 180]. a reversal keeps the sign of bearing2 - bearing1 (once both are in
+    # [0, 360)), so a U-turn in rotations() is a right or a left turn depending on the bearings
     bearing1 = (bearing1 + 360) % 360
     bearing2 = (bearing2 + 360) % 360
     result = bearing2 - bearing1
@@ -62,6 +145,15 @@ def bearing_difference(bearing1, bearing2):
     return result - 360 if result > 180 else result + 360 if result < -180 else result
 
 
+def bearing_difference_vec(bearings1, bearings2):
+    # bearing_difference() for arrays of bearings
+    bearings1 = np.mod(np.asarray(bearings1, dtype=np.float64) + 360, 360)
+    bearings2 = np.mod(np.asarray(bearings2, dtype=np.float64) + 360, 360)
+    result = bearings2 - bearings1
+
+    return np.where(result > 180, result - 360, np.where(result < -180, result + 360, result))
+
+
 def crosstrack_error(p1, p2, p3, ellipsoid=None):
     # from https://github.com/FlightDataServices/FlightDataUtilities/blob/master/flightdatautilities/geometry.py
 
@@ -75,12 +167,43 @@ def crosstrack_error(p1, p2, p3, ellipsoid=None):
 
 
 def along_track_distance(p1, p2, p3, ellipsoid=None):
-    d13 = geodist(p1, p3)
-    dxt = crosstrack_error(p1, p2, p3, ellipsoid=ellipsoid)
+    return track_distances(p1, p2, p3, ellipsoid=ellipsoid)[1]
+
+
+def track_distances(p1, p2, p3, ellipsoid=None):
+    # crosstrack_error() and along_track_distance() together. the bearings from p1 to p2 and p3 and the distance
+    # from p1 to p3 are calculated as in bearing_to() and geodist(), but inline so that the sine and cosine of
+    # each latitude are only taken once
+    lon1, lat1 = p1
+    lon2, lat2 = p2
+    lon3, lat3 = p3
+    rlat1, rlat2, rlat3 = radians(lat1), radians(lat2), radians(lat3)
+    sinlat1, coslat1 = sin(rlat1), cos(rlat1)
+    coslat2, coslat3 = cos(rlat2), cos(rlat3)
+
+    dlon12 = radians(lon2-lon1)
+    dlon13 = radians(lon3-lon1)
+    if p1 == p2:
+        bearing_true = float('nan')
+    else:
+        bearing_true = degrees(atan2(sin(dlon12) * coslat2, coslat1*sin(rlat2) - sinlat1*coslat2*cos(dlon12)))
+        bearing_true = bearing_true if bearing_true >= 0 else bearing_true + 360
+    if p1 == p3:
+        bearing = float('nan')
+    else:
+        bearing = degrees(atan2(sin(dlon13) * coslat3, coslat1*sin(rlat3) - sinlat1*coslat3*cos(dlon13)))
+        bearing = bearing if bearing >= 0 else bearing + 360
+    diffbearing = radians(bearing_difference(bearing, bearing_true))
+
     radius = _radius(p1, p2, ellipsoid)
-    result = acos(cos(d13 / radius) / cos(dxt / radius)) * radius
-    angle = abs(bearing_difference(bearing_to(p1, p2), bearing_to(p1, p3)))
-    return result if angle <= 90 else -result
+    sindlat = sin(radians(lat3-lat1)/2)
+    sindlon = sin(radians(lon3-lon1)/2)
+    angle13 = 2 * asin(sqrt(min(1.0, sindlat * sindlat + coslat1 * coslat3 * sindlon * sindlon)))
+
+    dxt = asin(sin(angle13) * sin(diffbearing)) * radius
+    result = acos(cos(angle13) / cos(dxt / radius)) * radius
+    angle = abs(bearing_difference(bearing_true, bearing))
+    return dxt, result if angle <= 90 else -result
 
 
 def sm_project(pt):
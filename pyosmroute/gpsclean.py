@@ -5,52 +5,119 @@ Library for cleaning raw GPS data
 import datetime
 import numpy as np
 
-from .geomeasure import geodist, bearing_to, bearing_difference
+from .geomeasure import geodist, geodist_approx, geodist_vec, bearing_to_vec, bearing_difference_vec, \
+    _haversine, _haversine_limit
 from .logger import log
 
 
-def _where(arg):
-    # this exists because 1-arg np.where is not supported in pypy
-    return np.array([i for i, item in enumerate(arg) if item])
+def _striptime(text):
+    # drop fractional seconds, time zone and quotes, leaving text both strptime() and numpy can parse
+    return str(text).split(".")[0].split("+")[0].replace('"', "").replace("Z", "").replace("T", " ")
 
-def _parsetime(text):
+
+def _parsetime(text, cache=None):
     if text:
-        stripped = str(text).split(".")[0].split("+")[0].replace('"', "").replace("Z", "").replace("T", " ")
-        return datetime.datetime.strptime(stripped, "%Y-%m-%d %H:%M:%S")
+        stripped = _striptime(text)
+        if cache is None:
+            return datetime.datetime.strptime(stripped, "%Y-%m-%d %H:%M:%S")
+        try:
+            return cache[stripped]
+        except KeyError:
+            cache[stripped] = parsed = datetime.datetime.strptime(stripped, "%Y-%m-%d %H:%M:%S")
+            return parsed
     else:
         return None
 
 
-def _distbyrow(row1, row2, lon_col="Longitude", lat_col="Latitude"):
-    return geodist((row1[lon_col], row1[lat_col]), (row2[lon_col], row2[lat_col]))
+def _column(df, col):
+    # column by name or position for both pyosmroute.DataFrame and pandas.DataFrame
+    try:
+        return df[col]
+    except KeyError:
+        return df.iloc[:, col]
+
 
+def seconds_between(t1, t2):
+    """
+    Return the whole seconds from t1 to t2, wrapped to within a day as timedelta.seconds is.
 
-def _velbyrow(row1, row2, datetime_col="_datetime", lon_col="Longitude", lat_col="Latitude"):
-    dist = _distbyrow(row1, row2, lon_col=lon_col, lat_col=lat_col)
-    difftime = (row2[datetime_col] - row1[datetime_col]).seconds
+    :param t1: A datetime64 or datetime value, or an array of them.
+    :param t2: A datetime64 or datetime value, or an array of them.
+    :return: The number of seconds (nan where either time is missing), a scalar if both times are scalars.
+    """
+    diff = np.asarray(t2, dtype="datetime64[s]") - np.asarray(t1, dtype="datetime64[s]")
+    return np.where(np.isnat(diff), float("nan"), diff.astype(np.int64) % 86400)[()]
+
+
+def _velbetween(lons, lats, times, i, j):
+    # velocity from point i to point j, from columns rather than rows
+    dist = geodist((lons[i], lats[i]), (lons[j], lats[j]))
+    difftime = seconds_between(times[i], times[j])
     return dist / difftime if difftime != 0 else float("nan")
 
 
-def _bearingbyrow(row1, row2, lat_col="Latitude", lon_col="Longitude"):
-    return bearing_to((row1[lon_col], row1[lat_col]), (row2[lon_col], row2[lat_col]))
+def _per_second(values, seconds):
+    # nan where no time has passed
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(seconds != 0, values / seconds, float("nan"))
+
+
+def _lowdistance(lons, lats, skip, min_distance):
+    # points that are within min_distance of the last point kept. which point that is depends on the result
+    # for every point before it, so this can't be one numpy call; looping over python floats rather than
+    # numpy scalars keeps the loop cheap
+    lons, lats, skip = lons.tolist(), lats.tolist(), skip.tolist()
+    out = [False] * len(lons)
+    # the equirectangular approximation decides points that are clearly closer or further than min_distance,
+    # the haversine distance is only needed near the threshold (or near the poles, where the approximation fails).
+    # even then it is compared as the haversine of the angle, so there is no square root or asin
+    approx = max(abs(lat) for lat in lats) <= 85
+    near, far = min_distance * 0.99, min_distance * 1.01
+    limit = _haversine_limit(min_distance)
+    pt = (lons[0], lats[0])
+    for i in range(1, len(lons)):
+        if skip[i]:
+            continue
+        newpt = (lons[i], lats[i])
+        dist = geodist_approx(pt, newpt) if approx else min_distance
+        if dist < near or (dist <= far and _haversine(pt, newpt) <= limit):
+            out[i] = True
+        else:
+            pt = newpt
+    return np.array(out, dtype=bool)
+
+
+def _velocities(lons, lats, times, nwindow=2):
+    start, end = _windows(len(lons), nwindow)
+    dists = geodist_vec(lons[start], lats[start], lons[end], lats[end])
+    return _per_second(dists, seconds_between(times[start], times[end]))
 
 
-def _rotationbyrow(row1, row2, bearing_col="_bearing", datetime_col="_datetime"):  # need rows as dicts here
-    bearing = bearing_difference(row1[bearing_col], row2[bearing_col])
-    difftime = (row2[datetime_col] - row1[datetime_col]).seconds
-    # in degrees per second, positive means turning right, negative turning left
-    return bearing / difftime if difftime != 0 else float("nan")
+def _windows(n, nwindow):
+    # indices of the first and last point of the window around each point
+    iminus = nwindow // 2
+    iplus = nwindow - iminus - 1
+    index = np.arange(n)
+    return np.maximum(0, index - iminus), np.minimum(index + iplus, n - 1)
 
 
 def datetimes(df, unparsed_col=0):
     """
-    Return a list of parsed date/times given a DataFrame and column.
+    Return parsed date/times given a DataFrame and column.
 
     :param df: A DataFrame
     :param unparsed_col: The column identifier to parse.
-    :return: A list of parsed dates.
+    :return: A datetime64[s] ndarray of parsed dates (NaT where the text is empty).
     """
-    return [_parsetime(df.iloc[i][unparsed_col]) for i in range(len(df))]
+    texts = _column(df, unparsed_col)
+    try:
+        # numpy parses the whole column in C
+        return np.array([_striptime(text) if text else "NaT" for text in texts], dtype="datetime64[s]")
+    except ValueError:
+        # numpy only reads ISO 8601, strptime is more forgiving (e.g. of single digit months).
+        # sub-second timestamps are truncated to the same string, so each distinct string is only parsed once
+        cache = {}
+        return np.array([_parsetime(text, cache) for text in texts], dtype="datetime64[s]")
 
 
 def velocities(df, nwindow=2, datetime_col="_datetime", lon_col="Longitude", lat_col="Latitude"):
@@ -62,14 +129,11 @@ def velocities(df, nwindow=2, datetime_col="_datetime", lon_col="Longitude", lat
     :param datetime_col: The column containing the parsed datetimes.
     :param lon_col: The column containing longitude information.
     :param lat_col: The column containing latitude information.
-    :return: A list of velocities in metres per second.
+    :return: An ndarray of velocities in metres per second.
     """
     # nwindow: number of points to consider
-    iminus = nwindow // 2
-    iplus = nwindow - iminus - 1
-    return [_velbyrow(df.iloc[max(0, i - iminus)], df.iloc[min(i + iplus, len(df) - 1)],
-                      datetime_col=datetime_col, lon_col=lon_col, lat_col=lat_col)
-            for i in range(len(df))]
+    return _velocities(np.asarray(df[lon_col], dtype=np.float64), np.asarray(df[lat_col], dtype=np.float64),
+                       df[datetime_col], nwindow)
 
 
 def distances(df, lon_col="Longitude", lat_col="Latitude"):
@@ -79,10 +143,14 @@ def distances(df, lon_col="Longitude", lat_col="Latitude"):
     :param df: A DataFrame
     :param lon_col: The column containing longitude information.
     :param lat_col: The column containing latitude information.
-    :return: A list of distances in metres.
+    :return: An ndarray of distances in metres.
     """
-    return [float("nan"), ] + [_distbyrow(df.iloc[i - 1], df.iloc[i], lon_col=lon_col, lat_col=lat_col)
-                               for i in range(1, len(df))]
+    lons = np.asarray(df[lon_col], dtype=np.float64)
+    lats = np.asarray(df[lat_col], dtype=np.float64)
+    out = np.empty(len(lons))
+    out[:1] = float("nan")
+    out[1:] = geodist_vec(lons[:-1], lats[:-1], lons[1:], lats[1:])
+    return out
 
 
 def bearings(df, nwindow=2, datetime_col="_datetime", lon_col="Longitude", lat_col="Latitude"):
@@ -93,13 +161,12 @@ def bearings(df, nwindow=2, datetime_col="_datetime", lon_col="Longitude", lat_c
     :param nwindow: The number of points to consider (2 is valid, uses previous point and current point)
     :param lon_col: The column containing longitude information.
     :param lat_col: The column containing latitude information.
-    :return: A list of bearings in degrees.
+    :return: An ndarray of bearings in degrees.
     """
-    iminus = nwindow // 2
-    iplus = nwindow - iminus - 1
-    return [_bearingbyrow(df.iloc[max(0, i - iminus)], df.iloc[min(i + iplus, len(df) - 1)],
-                          lon_col=lon_col, lat_col=lat_col)
-            for i in range(len(df))]
+    start, end = _windows(len(df), nwindow)
+    lons = np.asarray(df[lon_col], dtype=np.float64)
+    lats = np.asarray(df[lat_col], dtype=np.float64)
+    return bearing_to_vec(lons[start], lats[start], lons[end], lats[end])
 
 
 def rotations(df, nwindow=2):
@@ -108,12 +175,47 @@ def rotations(df, nwindow=2):
 
     :param df: A DataFrame
     :param nwindow: The number of points to consider (2 is valid, uses previous point and current point)
-    :return: A list of rotations in degrees/second.
+    :return: An ndarray of rotations in degrees/second.
     """
-    iminus = (nwindow) // 2
-    iplus = nwindow - iminus - 1
-    return [_rotationbyrow(df.iloc[max(0, i - iminus)], df.iloc[min(i + iplus, len(df) - 1)])
-            for i in range(len(df))]
+    start, end = _windows(len(df), nwindow)
+    bearings, times = df["_bearing"], df["_datetime"]
+    # positive means turning right, negative turning left
+    return _per_second(bearing_difference_vec(bearings[start], bearings[end]),
+                       seconds_between(times[start], times[end]))
+
+
+def compute_motion(df, nwindow=2, datetime_col="_datetime", lon_col="Longitude", lat_col="Latitude"):
+    """
+    Calculate distances, velocities, bearings and rotations in one pass, reading the position and time
+    columns and calculating the window around each point only once.
+
+    :param df: A DataFrame
+    :param nwindow: The number of points to consider (2 is valid, uses previous point and current point)
+    :param datetime_col: The column containing the parsed datetimes.
+    :param lon_col: The column containing longitude information.
+    :param lat_col: The column containing latitude information.
+    :return: A tuple of ndarrays (distances, velocities, bearings, rotations) as returned by distances(),
+             velocities(), bearings() and rotations().
+    """
+    start, end = _windows(len(df), nwindow)
+    lons = np.asarray(df[lon_col], dtype=np.float64)
+    lats = np.asarray(df[lat_col], dtype=np.float64)
+    times = df[datetime_col]
+    seconds = seconds_between(times[start], times[end])
+
+    # each point is used in several pairs, so only take the sine and cosine of each latitude once
+    radlats = np.radians(lats)
+    sinlats, coslats = np.sin(radlats), np.cos(radlats)
+
+    dists = np.empty(len(lons))
+    dists[:1] = float("nan")
+    dists[1:] = geodist_vec(lons[:-1], lats[:-1], lons[1:], lats[1:], coslats1=coslats[:-1], coslats2=coslats[1:])
+    vels = _per_second(geodist_vec(lons[start], lats[start], lons[end], lats[end],
+                                   coslats1=coslats[start], coslats2=coslats[end]), seconds)
+    bearings = bearing_to_vec(lons[start], lats[start], lons[end], lats[end], sinlats1=sinlats[start],
+                              coslats1=coslats[start], sinlats2=sinlats[end], coslats2=coslats[end])
+    rots = _per_second(bearing_difference_vec(bearings[start], bearings[end]), seconds)
+    return dists, vels, bearings, rots
 
 
 def cleanpoints(indf, max_velocity=100, min_velocity=0, min_distance=None, recursion_limit=100, lat_column="Latitude",
@@ -125,10 +227,12 @@ def cleanpoints(indf, max_velocity=100, min_velocity=0, min_distance=None, recur
     :param max_velocity: Points that require a velocity greater than this will be discarded (in m/s)
     :param min_velocity: Points that that require a velocity slower than this will be discarded (in m/s)
     :param min_distance: Points that are with in this distance of the preious point will be discarded (in metres)
-    :param recursion_limit: Cleaned recursively so that places with multiple points in a bad location are covered.
+    :param recursion_limit: Cleaned repeatedly (up to this many extra passes) so that places with multiple points in a
+                            bad location are covered.
     :param lat_column: The column identifier for latitude in the indf.
     :param lon_column: The column identifier for longitude in the indf.
-    :return: A DataFrame of cleaned points, which may or may not be a copy of the original DataFrame.
+    :return: A DataFrame of cleaned points, which may or may not be a copy of the original DataFrame. Points with
+             no date/time are always removed.
     """
     # if less than 3 rows, return
     if len(indf) < 3:
@@ -137,50 +241,68 @@ def cleanpoints(indf, max_velocity=100, min_velocity=0, min_distance=None, recur
     # calculate velocities
     if "_datetime" not in indf:
         indf["_datetime"] = datetimes(indf)
-    indf["_velocity"] = velocities(indf, nwindow=2, lat_col=lat_column, lon_col=lon_column)
-    # test threshold and 0.0 velocity (same point repeated)
-    highpoints = list(_where(indf._velocity[1:] > max_velocity) + 1) if max_velocity is not None else []
-    lowpoints = list(_where(indf._velocity[1:] <= min_velocity) + 1) if min_velocity is not None else []
-    badpoints = list(set(highpoints + lowpoints))
-
-    # check first point
-    if 1 in badpoints:
-        # check velocity from 1 to 2
-        vel = _velbyrow(indf.iloc[1], indf.iloc[2], lat_col=lat_column, lon_col=lon_column)
-        if vel < max_velocity:
-            # 1 was added because 0 was the bad point
-            badpoints.remove(1)
-            badpoints.append(0)
-
-    # find points that violate the min_distance
-    lowdistpoints = []
-    if min_distance:
-        pt = (indf[lon_column][0], indf[lat_column][0])
-        for i in range(1, len(indf)):
-            if i in badpoints:
-                continue
-            newpt = (indf[lon_column][i], indf[lat_column][i])
-            if geodist(pt, newpt) <= min_distance:
-                lowdistpoints.append(i)
-            else:
-                pt = newpt
-        badpoints = badpoints + lowdistpoints
-
-    # if no bad points, return indf
-    if badpoints:
-        log("Removing %s fast, %s slow, %s low dist points (%0.1f percent; recursion level %s)" %
-            (len(highpoints), len(lowpoints), len(lowdistpoints), len(badpoints) * 100 / len(indf),
-             recursion_limit))
-        goodpoints = sorted(set(range(len(indf))).difference(set(badpoints)))
-        newdf = indf.iloc[goodpoints, :]
-
-        if recursion_limit > 0:
-            # perpetuating cleaning of slow points is probably not a good idea
-            return cleanpoints(newdf, min_velocity=min_velocity / 1.5 if min_velocity is not None else None,
-                               max_velocity=max_velocity,
-                               min_distance=None,
-                               recursion_limit=recursion_limit - 1, lat_column=lat_column, lon_column=lon_column)
+    alllons = np.asarray(indf[lon_column], dtype=np.float64)
+    alllats = np.asarray(indf[lat_column], dtype=np.float64)
+    alltimes = np.asarray(indf["_datetime"], dtype="datetime64[s]")
+
+    # each pass removes points that are still bad once their neighbours are gone. this used to be done by
+    # recursing on a copy of the DataFrame, now only the indices of the points that are kept are updated and
+    # the DataFrame is subset once at the end
+    # points without a time (empty text parses to NaT) have no velocity, so they could never be removed below
+    keep = np.flatnonzero(~np.isnat(alltimes))
+    if len(keep) < len(indf):
+        log("Removing %s points with no date/time", len(indf) - len(keep))
+    velocity = None
+    while len(keep) >= 3:
+        lons, lats, times = alllons[keep], alllats[keep], alltimes[keep]
+        velocity = _velocities(lons, lats, times)
+        if len(keep) == len(indf):
+            indf["_velocity"] = velocity
+        # test threshold and 0.0 velocity (same point repeated)
+        highpoints = np.zeros(len(keep), dtype=bool)
+        lowpoints = np.zeros(len(keep), dtype=bool)
+        if max_velocity is not None:
+            highpoints[1:] = velocity[1:] > max_velocity
+        if min_velocity is not None:
+            lowpoints[1:] = velocity[1:] <= min_velocity
+        badpoints = highpoints | lowpoints
+
+        # check first point
+        if badpoints[1]:
+            # check velocity from 1 to 2
+            vel = _velbetween(lons, lats, times, 1, 2)
+            if vel < max_velocity:
+                # 1 was added because 0 was the bad point
+                badpoints[1] = False
+                badpoints[0] = True
+
+        # find points that violate the min_distance
+        if min_distance:
+            lowdistpoints = _lowdistance(lons, lats, badpoints, min_distance)
+            badpoints |= lowdistpoints
         else:
-            return newdf
-    else:
+            lowdistpoints = np.zeros(len(keep), dtype=bool)
+
+        # if no bad points, done
+        nbad = np.count_nonzero(badpoints)
+        if not nbad:
+            break
+        log("Removing %s fast, %s slow, %s low dist points (%0.1f percent; recursion level %s)",
+            np.count_nonzero(highpoints), np.count_nonzero(lowpoints), np.count_nonzero(lowdistpoints),
+            nbad * 100 / len(keep), recursion_limit)
+        goodpoints = ~badpoints
+        keep = keep[goodpoints]
+        velocity = velocity[goodpoints]
+        if recursion_limit <= 0:
+            break
+        # perpetuating cleaning of slow points is probably not a good idea
+        min_velocity = min_velocity / 1.5 if min_velocity is not None else None
+        min_distance = None
+        recursion_limit -= 1
+
+    if len(keep) == len(indf):
         return indf
+    newdf = indf.iloc[keep, :]
+    if velocity is not None:
+        newdf["_velocity"] = velocity
+    return newdf
@@ -2,6 +2,9 @@
 import logging
 
 __is_configured = False
+# messages go to the root logger (as with logging.log()), which is looked up once rather than on every message
+_root = logging.getLogger()
+_STRING_TYPES = (str, type(u""))
 DEBUG = "debug"
 ERROR = "error"
 MESSAGE = "message"
@@ -21,17 +24,29 @@ def config_logger(**kwargs):
     __is_configured = True
 
 
-def log(message, level=logging.DEBUG, stacktrace=False):
+def log(message, *args, **kwargs):
     """
     Log a message from this package.
 
-    :param message: The message
-    :param level: the logging level to use
-    :param stacktrace: Print a stacktrace of the last exception.
+    :param message: The message, which may contain %-style placeholders for args.
+    :param args: Values for the placeholders in message. They are only formatted into the message if it is
+                 actually logged, so pass them here rather than formatting the message beforehand.
+    :param level: (keyword) the logging level to use
+    :param stacktrace: (keyword) Print a stacktrace of the last exception.
     """
+    level = kwargs.pop("level", logging.DEBUG)
+    stacktrace = kwargs.pop("stacktrace", False)
+    if kwargs:
+        raise TypeError("log() got unexpected keyword arguments: %s" % ", ".join(kwargs))
+    if args and len(args) <= 2 and isinstance(args[0], int) and \
+            not (isinstance(message, _STRING_TYPES) and "%" in message):
+        # log(message, level[, stacktrace]) from before log() took arguments for the message
+        level = args[0]
+        stacktrace = args[1] if len(args) == 2 else stacktrace
+        args = ()
     if not __is_configured:
         return
     if stacktrace:
-        logging.exception(message)
+        _root.exception(message, *args)
     else:
-        logging.log(level, message)
\ No newline at end of file
+        _root.log(level, message, *args)
@@ -3,27 +3,15 @@ import numpy as np
 from ..logger import log
 
 
-def _coorditer(numpyarray):
-    it = numpyarray.flat
-    while True:
-        try:
-            c = it.coords
-            next(it)
-            yield c
-            pass
-        except StopIteration:
-            break
-
-
 def _unravel_index(k, shape):
     # pypy does not implement np.unravel_index(index, shape)
     if len(shape) == 1:
         return int(k)
-    elif len(shape) == 2:
-        ncol = shape[1]
-        return int(k/ncol), int(k%ncol)
-    else:
-        raise NotImplementedError("Custom _unravel_index not available for shape > 2 dimensions")
+    index = []
+    for dim in reversed(shape):
+        k, rem = divmod(int(k), dim)
+        index.append(rem)
+    return tuple(reversed(index))
 
 
 class HiddenMarkovModel(object):
@@ -38,6 +26,16 @@ class HiddenMarkovModel(object):
         self.eprobs = eprobs # eprobs[t][i] = number between 0 and 1
         self.tprobs = tprobs # TransitionProbabilities object
         self.queue = []
+        # dense[t][i, j] if all transition probabilities are already known, None if they are calculated on demand
+        self._dense = tprobs.as_dense([len(e) for e in eprobs])
+
+    def _tprob_row(self, t, i, n):
+        return self._dense[t][i] if self._dense is not None else self.tprobs.getprob_row(t, i, n)
+
+    def _tprob_matrix(self, t, nprev, nnext):
+        if self._dense is not None:
+            return self._dense[t]
+        return np.array([self.tprobs.getprob_row(t, i, nnext) for i in range(nprev)])
 
     def viterbi(self):
         """
@@ -48,16 +46,18 @@ class HiddenMarkovModel(object):
         path = []  # a list of the 'i' chosen for each time 't' and its probability
 
         for t in range(len(self.eprobs)):
-            eprobs = self.eprobs[t]
-            tprobs = [self.tprobs[t-1, path[-1][0], j] for j in range(len(eprobs))] \
-                if path and None not in path[-1] else np.repeat(1, len(eprobs))
-            assert len(eprobs) == len(tprobs)  # has to be true
-            probs = [tprobs[i]*eprobs[i] for i in range(len(eprobs))]  # calculate product of emmision and transition
-            if np.all(np.array(probs) == 0):
+            eprobs = np.asarray(self.eprobs[t], dtype=np.float64)
+            if path and None not in path[-1]:
+                # calculate product of emmision and transition
+                probs = self._tprob_row(t-1, path[-1][0], len(eprobs)) * eprobs
+            else:
+                probs = eprobs
+            if not probs.any():
                 path.append((None, 0))
-                log("Unresolvable break in viterbi at t=%s" % t)
+                log("Unresolvable break in viterbi at t=%s", t)
             else:
-                path.append((max(enumerate(probs), key=lambda x: x[1])))
+                idx = probs.argmax()
+                path.append((int(idx), probs[idx]))
 
         return path
 
@@ -79,7 +79,7 @@ class HiddenMarkovModel(object):
 
             if np.all(probs == 0):
                 path.append((None, 0))
-                log("Unresolvable break in viterbi at t=%s" % t)
+                log("Unresolvable break in viterbi at t=%s", t)
             else:
                 # minind = np.unravel_index(probs.argmax(), probs.shape)
                 minind = _unravel_index(probs.argmax(), probs.shape)
@@ -96,15 +96,11 @@ class HiddenMarkovModel(object):
         :param lookahead: The number of steps to look ahead
         :return: An n-dimentional array such that probs[t][t+1][t+2]...[t+lookahead] = the probability to be maximized
         """
-        eprobs = [self.eprobs[t0+plust] for plust in range(lookahead+1)] # list of length lookahead
-        probs = np.ndarray(shape=[len(subeprobs) for subeprobs in eprobs], dtype=float)
-        for index in _coorditer(probs):
-            prob = 1
-            for plust, j in enumerate(index):
-                t = t0 + plust - 1
-                i = int(index[plust-1] if plust != 0 else prev_i)
-                tprob = self.tprobs[t, i, j]
-                eprob = eprobs[plust][j]
-                prob *= tprob * eprob
-            probs[index] = prob
+        eprobs = [np.asarray(self.eprobs[t0+plust], dtype=np.float64) for plust in range(lookahead+1)]
+        probs = self._tprob_row(t0-1, prev_i, len(eprobs[0])) * eprobs[0]
+        for plust in range(1, lookahead+1):
+            t = t0 + plust - 1
+            # tmatrix[i, j] = tprob[t, i, j] * eprobs[plust][j], broadcast against the last dimension of probs
+            tmatrix = self._tprob_matrix(t, len(eprobs[plust-1]), len(eprobs[plust])) * eprobs[plust]
+            probs = probs[..., np.newaxis] * tmatrix
         return probs
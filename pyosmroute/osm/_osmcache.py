@@ -1,7 +1,7 @@
 
 import numpy as np
 
-from ..geomeasure import geodist, bearing_to, crosstrack_error, bearing_difference, along_track_distance
+from ..geomeasure import geodist, bearing_to, track_distances
 from ._routing import Router
 from ..logger import log
 
@@ -56,123 +56,185 @@ def _weighting(transport, tag):
         return 0
 
 
-def _bearing_diff(bearinggps, bearingroad, oneway):
-    diff = bearing_difference(bearinggps, bearingroad)
-    return diff if oneway else (diff if diff <= 90 else 180-diff)
+# typetags are stored in the cache as integer codes, with one code for all unknown tags
+_TYPETAGS = sorted(set(_WEIGHTINGS) | set(_EQUALTAGS))
+_TYPETAG_CODES = dict((tag, i) for i, tag in enumerate(_TYPETAGS))
+_UNKNOWN_TYPETAG = len(_TYPETAGS)
+
+
+def _weight_table(transport):
+    # weights indexed by typetag code
+    return np.array([_weighting(transport, tag) for tag in _TYPETAGS] + [0, ], dtype=np.float64)
 
 
 def _isoneway(waydict):
     return ("oneway" in waydict["tags"]) and (waydict["tags"]["oneway"] in ('yes', 'true', '1'))
 
 
-def _distcompare(p1, p2, p3):
-    x1, y1 = p1
-    x2, y2 = p2
+def _distcompare(x1, y1, x2, y2, p3):
+    # squared planar distance from p3 to each segment (x1[k], y1[k]) -> (x2[k], y2[k])
     x3, y3 = p3
-    px = x2-x1
-    py = y2-y1
+    px = x2 - x1
+    py = y2 - y1
 
     something = px*px + py*py
 
-    u = ((x3 - x1) * px + (y3 - y1) * py) / float(something)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = ((x3 - x1) * px + (y3 - y1) * py) / something
+    u[something == 0] = 0
+    u = np.clip(u, 0, 1)
 
-    if u > 1:
-        u = 1
-    elif u < 0:
-        u = 0
+    dx = x1 + u * px - x3
+    dy = y1 + u * py - y3
 
-    x = x1 + u * px
-    y = y1 + u * py
+    return dx*dx + dy*dy
 
-    dx = x - x3
-    dy = y - y3
 
-    return dx*dx + dy*dy
+_SEGMENT_DTYPE = np.dtype([("wayid", np.int64), ("segment", np.int64), ("node1", np.int64), ("node2", np.int64),
+                           ("p1_lon", np.float64), ("p1_lat", np.float64), ("p2_lon", np.float64),
+                           ("p2_lat", np.float64), ("distance", np.float64), ("bearing", np.float64),
+                           ("oneway", np.bool_), ("typecode", np.int16), ("weight", np.float64)])
 
 
 class OSMCache(object):
     """
-    An object representing a cache of ways and nodes from a PlanetDB. Attribute nodes is a dict
-    with a key of node_id, attribute ways is a dict with key of way_id, routing is a dict such
-    that routing[from_node_id][to_node_id] = segment, where segment is a dict containing information
-    about the segment. Transportation type is not really implemented, but could be if the appropriate
-    ways were selected using a query from the database.
+    An object representing a cache of ways and nodes from a PlanetDB. Node positions are stored
+    in the arrays node_lon and node_lat, indexed by node_index[node_id]. Segments (pairs of consecutive
+    nodes in a way) are rows of the structured array segments, with the rows for each way given by
+    way_segments[way_id]. Attribute ways is a dict with key of way_id, routing is a dict such
+    that routing[from_node_id][to_node_id] = the index of the segment in segments. The weight and distance
+    columns of segments are also kept as the lists segment_weight and segment_distance, which are faster to
+    index one value at a time while routing. Use node() and segment() to get this information as a dict.
+    Transportation type is not really implemented, but could be if the appropriate ways were selected using a
+    query from the database.
     """
 
     def __init__(self, db, trans_type="car"):
         self.trans_type = trans_type
+        self.weight_table = _weight_table(trans_type)
         self.db = db
-        self.nodes = {}
         self.ways = {}
         self.routing = {}
+        self.node_index = {}
+        self.node_lon = np.empty(0, dtype=np.float64)
+        self.node_lat = np.empty(0, dtype=np.float64)
+        self.node_tags = []
+        self.segments = np.empty(0, dtype=_SEGMENT_DTYPE)
+        self.segment_weight = []
+        self.segment_distance = []
+        self.way_segments = {}
+        self.routes = {}
 
     def addways(self, *wayids):
         """
-        Add ways to the cache by id.
+        Add ways to the cache by id. Ways that are already cached are not fetched again.
 
         :param wayids: A list of wayids.
         """
-        # get ways in single query
-        ways = self.db.ways(*wayids)
+        # get ways not already in the cache in single query
+        wayids = [wayid for wayid in wayids if wayid not in self.ways]
+        if not wayids:
+            return
+        # new ways can change the result of any route
+        self.routes = {}
+        ways = self.db.ways_raw(*wayids)
         # get nodes in single query
-        nodeids = set([item for sublist in [ways.iloc[i]['nodes'] for i in range(len(ways))] for item in sublist])
+        nodeids = set([item for way in ways for item in way["nodes"]])
         self.addnodes(*nodeids)
 
-        for i in range(len(ways)):
-            way = ways.iloc[i]
-            self.ways[way["id"]] = way
+        first = len(self.segments)
+        rows = []
+        for way in ways:
             nodes = way["nodes"]
+            tags = way["tags"]
+            way["typetag"] = typetag = tags["railway"] if self.trans_type == "train" else tags["highway"]
+            way["name"] = tags["name"] if "name" in tags else None  # name is useful for debugging
+            self.ways[way["id"]] = way
             oneway = _isoneway(way)
-            typetag = way["tags"]["railway"] if self.trans_type == "train" else way["tags"]["highway"]
-            name = way["tags"]["name"] if "name" in way["tags"] else None
+            typecode = _TYPETAG_CODES.get(typetag, _UNKNOWN_TYPETAG)
+            weight = self.weight_table[typecode]
 
-            # add links
+            if len(nodes) >= 2:
+                start = first + len(rows)
+                self.way_segments[way["id"]] = slice(start, start + len(nodes) - 1)
             for k in range(1, len(nodes)):
-                n1 = self.nodes[nodes[k-1]]
-                n2 = self.nodes[nodes[k]]
-                p1 = (n1["lon"], n1["lat"])
-                p2 = (n2["lon"], n2["lat"])
-                seg = {'wayid': way["id"],
-                        'segment': k,
-                        'p1': p1, 'p2': p2,
-                        'node1': nodes[k-1], 'node2': nodes[k],
-                        'distance': geodist(p1, p2),
-                        'bearing': bearing_to(p1, p2),
-                        'oneway': oneway,
-                        'typetag': typetag,
-                        'name': name, # useful for debugging
-                        'weight': _weighting(self.trans_type, typetag)
-                        }
-                self._addlink(seg)
-
-    def _addlink(self, seg, reverse=False):
-        nodes = (seg["node1"], seg["node2"]) if not reverse else (seg["node2"], seg["node1"])
+                p1 = self.node_lonlat(nodes[k-1])
+                p2 = self.node_lonlat(nodes[k])
+                rows.append((way["id"], k, nodes[k-1], nodes[k], p1[0], p1[1], p2[0], p2[1],
+                             geodist(p1, p2), bearing_to(p1, p2), oneway, typecode, weight))
+
+        self.segments = np.concatenate((self.segments, np.array(rows, dtype=_SEGMENT_DTYPE)))
+        self.segment_weight.extend(self.segments["weight"][first:].tolist())
+        self.segment_distance.extend(self.segments["distance"][first:].tolist())
+
+        # add links
+        node1 = self.segments["node1"][first:].tolist()
+        node2 = self.segments["node2"][first:].tolist()
+        oneway = self.segments["oneway"][first:].tolist()
+        for k in range(len(node1)):
+            self._addlink(node1[k], node2[k], first + k)
+            if not oneway[k]:
+                self._addlink(node2[k], node1[k], first + k)
+
+    def _addlink(self, fromnode, tonode, segindex):
         try:
-            self.routing[nodes[0]][nodes[1]] = seg
+            self.routing[fromnode][tonode] = segindex
         except KeyError:
-            self.routing[nodes[0]] = {nodes[1]: seg}
-        if not seg["oneway"] and not reverse:
-            self._addlink(seg, True)  # passing true here keeps from recursing more than once
+            self.routing[fromnode] = {tonode: segindex}
 
     def addnodes(self, *nodes):
         """
-        Add nodes to the database by ID.
+        Add nodes to the database by ID. Nodes that are already cached are not fetched again.
 
         :param nodes: A list of node ids.
         """
+        nodes = [nodeid for nodeid in nodes if nodeid not in self.node_index]
+        if not nodes:
+            return
         nodes = self.db.nodes(*nodes)
+        ids = nodes["id"]
+        start = len(self.node_tags)
         for i in range(len(nodes)):
-            node = nodes.iloc[i]
-            self.nodes[node["id"]] = node
-
-    def _segments(self, wayid):
-        waydict = self.ways[wayid]
-        nodes = waydict["nodes"]
-        for i in range(1, len(nodes)):
-            try:
-                yield self.routing[nodes[i-1]][nodes[i]]
-            except KeyError:
-                raise KeyError("Segment not found: wayid %s; segment %s" % (wayid, i))
+            self.node_index[ids[i]] = start + i
+        self.node_lon = np.concatenate((self.node_lon, np.asarray(nodes["lon"], dtype=np.float64)))
+        self.node_lat = np.concatenate((self.node_lat, np.asarray(nodes["lat"], dtype=np.float64)))
+        self.node_tags.extend(nodes["tags"])
+
+    def node_lonlat(self, nodeid):
+        """
+        :param nodeid: A node id.
+        :return: The (lon, lat) of the node.
+        """
+        i = self.node_index[nodeid]
+        return self.node_lon[i], self.node_lat[i]
+
+    def node(self, nodeid):
+        """
+        :param nodeid: A node id.
+        :return: A dict containing the id, lon, lat, and tags of the node.
+        """
+        i = self.node_index[nodeid]
+        return {"id": nodeid, "lon": self.node_lon[i], "lat": self.node_lat[i], "tags": self.node_tags[i]}
+
+    def segment(self, segindex):
+        """
+        :param segindex: The index of the segment in self.segments (as stored in self.routing).
+        :return: A new dict containing all cached information about the segment.
+        """
+        wayid, k, node1, node2, p1_lon, p1_lat, p2_lon, p2_lat, distance, bearing, oneway, typecode, weight = \
+            self.segments[segindex].item()
+        way = self.ways[wayid]
+        return {'wayid': wayid,
+                'segment': k,
+                'p1': (p1_lon, p1_lat), 'p2': (p2_lon, p2_lat),
+                'node1': node1, 'node2': node2,
+                'distance': distance,
+                'bearing': bearing,
+                'oneway': oneway,
+                'typetag': way["typetag"],
+                'name': way["name"],
+                'weight': weight
+                }
 
     def get_segment(self, wayid, pt):
         """
@@ -184,22 +246,44 @@ class OSMCache(object):
         """
         # information to compare with segments
         # delta parameter in the wiggle room in metres in regards to seeing if a segment is valid
-        segments = list(self._segments(wayid))
+        rows = self.way_segments[wayid]
+        segs = self.segments[rows]
         # find index where the two sequential nodes are the closest
-        dists = [_distcompare(s["p1"], s["p2"], pt) for s in segments]
-        seg = segments[np.argmin(dists)].copy()
+        dists = _distcompare(segs["p1_lon"], segs["p1_lat"], segs["p2_lon"], segs["p2_lat"], pt)
+        seg = self.segment(rows.start + int(np.argmin(dists)))
 
         p1 = seg["p1"]
         p2 = seg["p2"]
-        atrack = along_track_distance(p1, p2, pt)
+        xte, atrack = track_distances(p1, p2, pt)
         seg["alongtrack"] = atrack = atrack if atrack >= 0 and atrack <= seg["distance"] else \
             seg["distance"] if atrack >= seg["distance"] else 0
         seg["pt_onseg"] = (p1[0] + (p2[0]-p1[0])*atrack/seg["distance"], p1[1] + (p2[1]-p1[1])*atrack/seg["distance"])
-        seg["xte"] = abs(crosstrack_error(p1, p2, pt))
+        seg["xte"] = abs(xte)
         seg["dist_from_route"] = geodist(pt, seg["pt_onseg"]) # often close to xte but not if point is off end of route
         seg["pt"] = pt
         return seg
 
+    def route(self, startnode, endnode, maxdist=None):
+        """
+        Route between two nodes using the Router, remembering the result so that the many candidate segments
+        sharing start and end nodes only need one search.
+
+        :param startnode: The node id to start from.
+        :param endnode: A node id or tuple of node ids to end at.
+        :param maxdist: The maximum distance to search for a route (None for no limit, but not nan).
+        :return: A 3-tuple: result, nodelist, distance (in metres). The nodelist is a copy that may be modified.
+        """
+        if maxdist is not None and maxdist != maxdist:
+            # nan would never limit the search, and as a key never matches itself so would never be remembered
+            raise ValueError("maxdist is nan")
+        key = (startnode, endnode, maxdist)
+        try:
+            status, nodes, distance = self.routes[key]
+        except KeyError:
+            status, nodes, distance = Router(self, startnode, endnode, maxdist=maxdist).doRoute()
+            self.routes[key] = status, nodes, distance
+        return status, list(nodes), distance
+
     def driving_distance(self, s1, s2, maxdist=None, grace_distance=0.0):
         """
         Retreive the driving distance between two segments as returned by get_segment(). This means
@@ -223,14 +307,17 @@ class OSMCache(object):
         # if s1["node1"] == 93218183 and s1["node2"] == 105397191 and s2["node1"] == 105397185 and s2["node2"] == 93218131:
         #     pass
 
+        # the node ids are compared several times below, so look them up once
+        s1node1, s1node2, s1oneway = s1["node1"], s1["node2"], s1["oneway"]
+        s2node1, s2node2, s2oneway = s2["node1"], s2["node2"], s2["oneway"]
+
         if s1["wayid"] == s2["wayid"] and s1["segment"] == s2["segment"]:
             # are on same segment (probably most common)
             diff = s2["alongtrack"] - s1["alongtrack"]
             # check for 'going the wrong way'
-            if s1["oneway"] and diff < -grace_distance:
+            if s1oneway and diff < -grace_distance:
                 # do routing from the end node to the beginning node
-                router = Router(self, s1["node2"], s1["node1"])
-                status, nodes, distance = router.doRoute()
+                status, nodes, distance = self.route(s1node2, s1node1)
                 if nodes:
                     return distance + s1["distance"] + diff, nodes
                 else:
@@ -238,51 +325,49 @@ class OSMCache(object):
             else:
                 return abs(diff), []
 
-        if s1["node1"] == s2["node1"]:
-            if not s1["oneway"]:
-                return s1["alongtrack"] + s2["alongtrack"], [s1["node1"], ]
-        elif s1["node1"] == s2["node2"]:
-            if (not s1["oneway"]) and (not s2["oneway"]):
-                return s1["alongtrack"] + s2["distance"] - s2["alongtrack"], [s1["node1"], ]
-        elif s1["node2"] == s2["node1"]:
-            return s1["distance"] - s1["alongtrack"] + s2["alongtrack"], [s1["node2"],]
-        elif s1["node2"] == s2["node2"]:
-            if not s2["oneway"]:
-                return s1['distance'] - s1["alongtrack"] + s2['distance'] - s2["alongtrack"], [s1["node2"], ]
-
-        router = Router(self, s1["node1"], (s2["node1"], s2["node2"]), maxdist=maxdist)
-        status, nodes, distance = router.doRoute()
+        if s1node1 == s2node1:
+            if not s1oneway:
+                return s1["alongtrack"] + s2["alongtrack"], [s1node1, ]
+        elif s1node1 == s2node2:
+            if (not s1oneway) and (not s2oneway):
+                return s1["alongtrack"] + s2["distance"] - s2["alongtrack"], [s1node1, ]
+        elif s1node2 == s2node1:
+            return s1["distance"] - s1["alongtrack"] + s2["alongtrack"], [s1node2,]
+        elif s1node2 == s2node2:
+            if not s2oneway:
+                return s1['distance'] - s1["alongtrack"] + s2['distance'] - s2["alongtrack"], [s1node2, ]
+
+        status, nodes, distance = self.route(s1node1, (s2node1, s2node2), maxdist=maxdist)
 
         if nodes:
-            if s2["oneway"] and (s2["node1"] not in nodes):
+            if s2oneway and (s2node1 not in nodes):
                 # we need a different route
-                router = Router(self, s1["node1"], s2["node1"], maxdist=maxdist)
-                status, nodes, distance = router.doRoute()
+                status, nodes, distance = self.route(s1node1, s2node1, maxdist=maxdist)
                 # handle start/end distances
-                if s1["node2"] in nodes:
-                    nodes.remove(s1["node1"])
+                if s1node2 in nodes:
+                    nodes.remove(s1node1)
                     sdist = -s1["alongtrack"]
                 else:
                     sdist = s1["alongtrack"]
 
-                if s2["node2"] in nodes:
-                    nodes.remove(s2["node2"])
+                if s2node2 in nodes:
+                    nodes.remove(s2node2)
                     edist = -s2["alongtrack"]
                 else:
                     edist = s2["alongtrack"]
                 return sdist + edist + distance, nodes
             else:
                 # handle start/end distances
-                if s1["node2"] in nodes:
-                    nodes.remove(s1["node1"])
+                if s1node2 in nodes:
+                    nodes.remove(s1node1)
                     sdist = -s1["alongtrack"]
                 else:
                     sdist = s1["alongtrack"]
 
-                if s2["node1"] == nodes[-1]:
+                if s2node1 == nodes[-1]:
                     # end on node1
                     edist = s2["alongtrack"]
-                elif s2["node2"] == nodes[-1]:
+                elif s2node2 == nodes[-1]:
                     # end on node2
                     edist = s2["distance"] - s2["alongtrack"]
 
@@ -2,8 +2,11 @@
 Geometry tools for mapmatch.py
 """
 
+from math import exp
+
 import numpy as np
 from ..geomeasure import bearing_difference, geodist
+from ..gpsclean import seconds_between
 
 
 def _bearing_diff(bearinggps, bearingroad, oneway):
@@ -13,11 +16,12 @@ def _bearing_diff(bearinggps, bearingroad, oneway):
 
 def _emission_probability_formula(xte, sigmaZ):  # reasonable estimation for error in GPS noise (5 m)
     # return 1.0 / (np.sqrt(2 * np.pi) * sigmaZ) * np.exp(-0.5 * (xte / sigmaZ)**2)
-    return np.exp(-0.5 * (xte / sigmaZ)**2)  # returns one for xte = 0, easier
+    # these are called for every candidate segment, so use math.exp rather than numpy's scalar dispatch
+    return exp(-0.5 * (xte / sigmaZ)**2)  # returns one for xte = 0, easier
 
 
 def _transition_probability_formula(gpsdist, routedist, beta=10.0):
-    return np.exp(-(abs(gpsdist - routedist) / beta))
+    return exp(-(abs(gpsdist - routedist) / beta))
 
 
 def emission_probability(seg, point_dict, sigmaZ=1.0, maxspeed=30, bearing_penalty_weight=1):
@@ -39,10 +43,18 @@ def transition_probability(cache, seg1, seg2, gpsdist=None, beta=10.0, maxdist=N
     return tprob, nodes
 
 
-def _batch_transitions(cache, states, obs, t, i, maxvel, beta, grace_distance):
+def _step_limits(states, obs, t, maxvel):
+    # the gps distance and maximum driving distance between time t and t+1 are the same for all states
     gpsdist = geodist(states[t][0]["pt"], states[t+1][0]["pt"])  # could also use obs to do this here
-    dtime = (obs[t+1]["_datetime"] - obs[t]["_datetime"]).seconds
-    maxdist = dtime * maxvel
+    dtime = seconds_between(obs[t]["_datetime"], obs[t+1]["_datetime"])
+    if np.isnan(dtime):
+        # a nan limit would never stop the search (cleanpoints() removes points with no time, so this is a bug)
+        raise ValueError("Missing date/time for observation %s or %s" % (t, t+1))
+    return gpsdist, dtime * maxvel
+
+
+def _batch_transitions(cache, states, obs, t, i, maxvel, beta, grace_distance):
+    gpsdist, maxdist = _step_limits(states, obs, t, maxvel)
 
     probs = {}
     data = {}
@@ -59,13 +71,14 @@ def get_lazy(osmcache, obs, states, beta=10.0, grace_distance=0, maxvel=250):
 
 
 def get_all(osmcache, obs, states, beta=10.0, grace_distance=0, maxvel=250):
-    tis = [(t, i) for t, substates in enumerate(states) if t < len(states)-1 for i in range(len(substates))]
-    args = [(osmcache, states, obs, t, i, maxvel, beta, grace_distance) for t, i in tis]
     tprobs = DictTransitionProbabilities()
-    for result in map(_batch_transitions, *zip(*args)):
-        keys, probs, data = result
-        for key in keys:
-            tprobs[key] = probs[key], data[key]
+    for t in range(len(states)-1):
+        gpsdist, maxdist = _step_limits(states, obs, t, maxvel)
+        for i, seg1 in enumerate(states[t]):
+            for j, seg2 in enumerate(states[t+1]):
+                tprob, nodes = transition_probability(osmcache, seg1, seg2, gpsdist=gpsdist, beta=beta,
+                                                      maxdist=maxdist, grace_distance=grace_distance)
+                tprobs.put(t, i, j, tprob, nodes)
 
     return tprobs
 
@@ -95,6 +108,27 @@ class TransitionProbabilities(object):
     def getdata(self, t, i, j):
         raise NotImplementedError()
 
+    def getprob_row(self, t, i, n):
+        """
+        Get the transition probabilities from state i at time t to all n states at time t+1.
+
+        :param t: The time t.
+        :param i: The state at time t.
+        :param n: The number of states at time t+1.
+        :return: An ndarray of length n.
+        """
+        return np.array([self.getprob(t, i, j) for j in range(n)], dtype=np.float64)
+
+    def as_dense(self, sizes):
+        """
+        Get all transition probabilities as a list of 2D arrays such that as_dense(sizes)[t][i, j] is the
+        probability of moving from state i at time t to state j at time t+1.
+
+        :param sizes: The number of states at each time t.
+        :return: A list of ndarrays, or None if probabilities are calculated on demand.
+        """
+        return None
+
 
 class DictTransitionProbabilities(TransitionProbabilities):
 
@@ -102,10 +136,12 @@ class DictTransitionProbabilities(TransitionProbabilities):
         super(DictTransitionProbabilities, self).__init__()
         self.probs = {}
         self.data = {}
+        self.rows = {}
 
     def put(self, t, i, j, prob, data=None):
         self.probs[t, i, j] = prob
         self.data[t, i, j] = data
+        self.rows.pop((t, i), None)
 
     def getprob(self, t, i, j):
         return self.probs[t, i, j]
@@ -113,6 +149,20 @@ class DictTransitionProbabilities(TransitionProbabilities):
     def getdata(self, t, i, j):
         return self.data[t, i, j]
 
+    def getprob_row(self, t, i, n):
+        try:
+            return self.rows[t, i]
+        except KeyError:
+            row = np.fromiter((self.getprob(t, i, j) for j in range(n)), dtype=np.float64, count=n)
+            self.rows[t, i] = row
+            return row
+
+    def as_dense(self, sizes):
+        dense = [np.zeros((sizes[t], sizes[t+1]), dtype=np.float64) for t in range(len(sizes)-1)]
+        for (t, i, j), prob in self.probs.items():
+            dense[t][i, j] = prob
+        return dense
+
 
 class LazyTransitionProbabilities(DictTransitionProbabilities):
 
@@ -138,4 +188,7 @@ class LazyTransitionProbabilities(DictTransitionProbabilities):
         else:
             # could also calculate single prob here, but this slightly less lazy behaviour is probably more efficient
             self.calcprobs(t, i)
-            return self.probs[key]
\ No newline at end of file
+            return self.probs[key]
+
+    def as_dense(self, sizes):
+        return None
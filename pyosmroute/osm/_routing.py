@@ -1,6 +1,19 @@
 
+import heapq
+from math import sin, cos, asin, sqrt, radians
 import numpy as np
-from ..geomeasure import geodist
+from ..geomeasure import _radius
+
+
+def _nodes(item):
+    # each queue item only points to the item it was extended from, the node list is only built for the route
+    # that is returned
+    nodes = []
+    while item is not None:
+        nodes.append(item['end'])
+        item = item['previous']
+    nodes.reverse()
+    return nodes
 
 
 class Router(object):
@@ -23,6 +36,8 @@ class Router(object):
 
         self.data = cache
         self.queue = []
+        self.queued = set()
+        self.queuecount = 0
         self.maxdist = maxdist
         self.weights= weights
         self.maxcount = maxcount
@@ -30,8 +45,13 @@ class Router(object):
         if not hasattr(endnode, "__len__"):
             endnode = (endnode, )
         self.searchEnd = endnode
-        endnodes = [cache.nodes[nid] for nid in endnode]
-        self.searchendpos = np.mean([n["lon"] for n in endnodes]), np.mean([n["lat"] for n in endnodes])
+        endpos = [cache.node_lonlat(nid) for nid in endnode]
+        self.searchendpos = np.mean([p[0] for p in endpos]), np.mean([p[1] for p in endpos])
+        # the end of the search doesn't move, so its cosine is only calculated once (see _togo())
+        self.searchendcos = cos(radians(self.searchendpos[1]))
+        self.radius = _radius(None, self.searchendpos, None)
+        self.seg_weight = cache.segment_weight
+        self.seg_distance = cache.segment_distance
         self.seed = seed
         self.exclude = [] if exclude is None else list(exclude)
 
@@ -41,20 +61,25 @@ class Router(object):
 
         :return: A 3-tuple: result, nodelist, distance (in metres)
         """
-        closed = [self.searchStart, ] + self.exclude
+        closed = set([self.searchStart, ] + self.exclude)
+        # a heap of (maxdistance, insertion count, item), so that items with equal maxdistance come out in the
+        # order they were added, as they did from the sorted list this used to be
         self.queue = []
+        self.queued = set()
+        self.queuecount = 0
 
         # Start by queueing all outbound links from the start node
-        blankQueueItem = {'end': -1, 'distance': 0, 'weighted_distance': 0, 'nodes': [self.searchStart, ]}
+        blankQueueItem = {'end': self.searchStart, 'distance': 0, 'weighted_distance': 0, 'previous': None}
 
         try:
             if self.seed: # make sure first item in the queue is the seeded node
                 seg = self.data.routing[self.searchStart][self.seed]
-                self.addToQueue(self.searchStart, self.seed, blankQueueItem, seg["weight"], seg["distance"])
+                self.addToQueue(self.searchStart, self.seed, blankQueueItem, self.seg_weight[seg],
+                                self.seg_distance[seg])
             for nodeid, seg in self.data.routing[self.searchStart].items():
                 if nodeid == self.seed:
                     continue
-                self.addToQueue(self.searchStart, nodeid, blankQueueItem, seg["weight"], seg["distance"])
+                self.addToQueue(self.searchStart, nodeid, blankQueueItem, self.seg_weight[seg], self.seg_distance[seg])
         except KeyError:
             return 'no_such_node', [], 0.0
 
@@ -63,17 +88,18 @@ class Router(object):
         while count < self.maxcount:
             count += 1
             try:
-                nextItem = self.queue.pop(0)
+                nextItem = heapq.heappop(self.queue)[2]
             except IndexError:
                 # Queue is empty: failed
                 return 'no_route', [], 0.0
             x = nextItem['end']
+            self.queued.discard(x)
             if x in closed: # keeps track of all of the points that currently exist on routes to prevent double back
                 continue
             if x in self.searchEnd:
                 # Found the end node - success
-                return 'success', nextItem['nodes'], nextItem['distance']
-            closed.append(x)
+                return 'success', _nodes(nextItem), nextItem['distance']
+            closed.add(x)
 
             # test for distance greater than max distance, don't add to queue if this is true
             # had previously tested this before checking if this segment satisfied the route
@@ -84,7 +110,7 @@ class Router(object):
             try:
                 for i, seg in self.data.routing[x].items():
                     if i not in closed:
-                        self.addToQueue(x,i,nextItem, seg['weight'], seg['distance'])
+                        self.addToQueue(x,i,nextItem, self.seg_weight[seg], self.seg_distance[seg])
             except KeyError:
                 pass
         else:
@@ -93,12 +119,11 @@ class Router(object):
     def addToQueue(self, start, end, queueSoFar, weight=1, distance=1):
         """Add another potential route to the queue"""
 
-        end_pos = self.data.nodes[end]
+        end_pos = self.data.node_lonlat(end)
 
         # If already in queue, ignore
-        for test in self.queue:
-            if test['end'] == end:
-                return
+        if end in self.queued:
+            return
 
         if weight == 0 and self.weights:
             return
@@ -110,17 +135,21 @@ class Router(object):
         queueItem = {
               'distance': distanceSoFar + distance,
               'weighted_distance': weightedSoFar + weighted_distance,
-              'maxdistance': weightedSoFar + geodist((end_pos["lon"], end_pos["lat"]), self.searchendpos),
-              'nodes': list(queueSoFar['nodes']) + [end,],
+              'maxdistance': weightedSoFar + self._togo(end_pos),
+              'previous': queueSoFar,
               'end': end
             }
 
-        # Try to insert, keeping the queue ordered by decreasing worst-case distance
-        count = 0
-        for test in self.queue:
-            if test['maxdistance'] > queueItem['maxdistance']:
-                self.queue.insert(count,queueItem)
-                break
-            count += 1
-        else:
-            self.queue.append(queueItem)
+        # The item with the smallest worst-case distance is considered first
+        heapq.heappush(self.queue, (queueItem['maxdistance'], self.queuecount, queueItem))
+        self.queuecount += 1
+        self.queued.add(end)
+
+    def _togo(self, pos):
+        # geodist(pos, self.searchendpos), reusing the cosine of the end latitude for every node that is queued
+        lon, lat = pos
+        endlon, endlat = self.searchendpos
+        sindlat = sin(radians(endlat-lat)/2)
+        sindlon = sin(radians(endlon-lon)/2)
+        a = sindlat * sindlat + cos(radians(lat)) * self.searchendcos * sindlon * sindlon
+        return self.radius * (2 * asin(sqrt(min(1.0, a))))
@@ -1,7 +1,6 @@
 import time
 
 import numpy as np
-from gevent.pool import Pool
 
 from pyosmroute import gpsclean
 from ._hiddenmarkovmodel import HiddenMarkovModel
@@ -31,7 +30,8 @@ def nearest_road(db, radius, *points):
 def osmmatch(db, gpsdf, lat_column="Latitude", lon_column="Longitude", unparsed_datetime_col=0,
              searchradius=50, minpoints=10, maxvel=250, sigmaZ=10, beta=10.0, maxiter=1,
              minpointdistance=30, paramter_window=3, bearing_penalty_weight=1, viterbi_lookahead=1,
-             lazy_probabilities=True, points_summary=True, segments_summary=True, db_threads=20):
+             lazy_probabilities=True, points_summary=True, segments_summary=True, db_threads=20,
+             maxcandidates=None):
     """
     Match timestamped GPS points to roads in the OSM database. The matching is based a Hidden Markov Model
     with emission probabilities based on the distance to the road segment, and transition probabilities
@@ -84,7 +84,9 @@ def osmmatch(db, gpsdf, lat_column="Latitude", lon_column="Longitude", unparsed_
                                probabilties are used, so this does not lead to a performance increase.
     :param points_summary: True if the list of point/segment matches should be returned, False otherwise.
     :param segments_summary: True if the complete list of segments should be returned, False otherwise.
-    :param db_threads: Number of threads to execute synchronous queries.
+    :param db_threads: Ignored (nearby ways for all points are fetched in a single query). Kept for compatibility.
+    :param maxcandidates: The maximum number of nearby ways to consider for each GPS point, or None to consider
+                          all ways within searchradius.
     :return: A 3-tuple. The first item is a dictionary containing summary statistics about the match, the second
                 item is the points_summary, the third item is the segments_summary. If both points_summary
                 and segments_summary are False, the function returns an output that allows the complete
@@ -104,13 +106,15 @@ def osmmatch(db, gpsdf, lat_column="Latitude", lon_column="Longitude", unparsed_
     t_cleaned = time.time()
 
     log("Calculating velocities and directions...")
-    cleaned["_velocity"] = gpsclean.velocities(cleaned, nwindow=paramter_window, lat_col=lat_column, lon_col=lon_column)
-    cleaned["_bearing"] = gpsclean.bearings(cleaned, nwindow=paramter_window, lat_col=lat_column, lon_col=lon_column)
-    cleaned["_rotation"] = gpsclean.rotations(cleaned, nwindow=paramter_window)
-    cleaned["_distance"] = gpsclean.distances(cleaned, lat_col=lat_column, lon_col=lon_column)
+    distances, velocities, bearings, rotations = gpsclean.compute_motion(cleaned, nwindow=paramter_window,
+                                                                         lat_col=lat_column, lon_col=lon_column)
+    cleaned["_velocity"] = velocities
+    cleaned["_bearing"] = bearings
+    cleaned["_rotation"] = rotations
+    cleaned["_distance"] = distances
 
     if len(cleaned) < minpoints:
-        log("Too few points to perform matching (%s)" % len(gpsdf))
+        log("Too few points to perform matching (%s)", len(gpsdf))
         return {"result": "not_enough_points"}, DataFrame(), DataFrame()
 
     # at least have output columns have a standard name
@@ -121,22 +125,20 @@ def osmmatch(db, gpsdf, lat_column="Latitude", lon_column="Longitude", unparsed_
         del cleaned[lon_column]
 
     # from now on, don't refer to gps data frame, just the gps points (list of dicts)
-    gpspoints = [cleaned.iloc[i] for i in range(len(cleaned))]
+    # all rows share one column index, built once by itertuples() rather than per row by iloc
+    gpspoints = list(cleaned.itertuples(rownames=False))
     t_velocity_direction = time.time()
 
-    log("Fetching all possible ways within radius %s..." % searchradius)
-    tp = Pool(db_threads if db_threads else len(gpspoints))
-    ways = list(tp.imap(db.nearest_ways, cleaned["Longitude"], cleaned["Latitude"],
-                        np.repeat(searchradius, len(gpspoints))))
-
-    # ways = [db.nearest_ways(p["Longitude"], p["Latitude"], radius=searchradius) for p in gpspoints]
+    log("Fetching all possible ways within radius %s...", searchradius)
+    ways = db.nearest_ways_batch(cleaned["Longitude"], cleaned["Latitude"], radius=searchradius,
+                                 limit=maxcandidates)
     t_fetchways = time.time()
 
     log("Building in-memory cache...")
     cache = OSMCache(db)
     idlist = set([item for sublist in ways for item in sublist])
     cache.addways(*idlist)  # best done like this so there is only one query to the database
-    log("Loaded %s nodes and %s ways with %s links" % (len(cache.nodes), len(cache.ways), len(cache.routing)))
+    log("Loaded %s nodes and %s ways with %s links", len(cache.node_index), len(cache.ways), len(cache.routing))
     t_cache = time.time()
 
     log("Calculating emission probabilities...")
@@ -173,7 +175,7 @@ def osmmatch(db, gpsdf, lat_column="Latitude", lon_column="Longitude", unparsed_
         count += 1
         # clean bad points identified by previous iteration
         if badpoints:
-            log("Removing %s bad points identified by previous iteration" % len(badpoints))
+            log("Removing %s bad points identified by previous iteration", len(badpoints))
         for t in reversed(badpoints):
             # removing t-1 here is a judgement call...the bad point could easily be at t (or t+1)
             # until routing though the HMM is perfected, this is a mute point
@@ -245,8 +247,8 @@ def osmmatch(db, gpsdf, lat_column="Latitude", lon_column="Longitude", unparsed_
     if points_summary:
         summary = _points_summary(cache, gpspoints, pathsegs)
         _summary_statistics(summary, output=stats, gps_distance=(np.nansum, "gps__distance"), mean_xte=(np.mean, "xte"))
-        dur_sec = (summary["gps__datetime"][len(summary)-1] - summary["gps__datetime"][0]).seconds
-        stats["trip_duration_min"] = dur_sec / 60.0
+        dur_sec = gpsclean.seconds_between(summary["gps__datetime"][0], summary["gps__datetime"][len(summary)-1])
+        stats["trip_duration_min"] = float(dur_sec) / 60.0
     else:
         summary = DataFrame()
 
@@ -268,8 +270,8 @@ def osmmatch(db, gpsdf, lat_column="Latitude", lon_column="Longitude", unparsed_
     summarytime = time.time() - t_start - telapsed
     stats["t_summary"] = summarytime
 
-    log("Done: %s points in %0.1f sec (%d points/sec) matching, %0.1f sec summary" %
-        (len(cleaned), telapsed, len(cleaned) / telapsed, summarytime))
+    log("Done: %s points in %0.1f sec (%d points/sec) matching, %0.1f sec summary",
+        len(cleaned), telapsed, len(cleaned) / telapsed, summarytime)
     return stats, summary, tripsummary
 
 
@@ -288,9 +290,10 @@ def make_linestring(segsoutput):
     # loop through segs output testing for breaks. beginning of breaks use the
     # pt_onseg as the beginning point and p2 as the end point. end of breaks use
     # pt_onseg as
-    for i in range(len(segsoutput)):
-        row = segsoutput.iloc[i]
-        nextrow = segsoutput.iloc[i+1] if i+1 < len(segsoutput) else None
+    rows = list(segsoutput.itertuples(rownames=False))
+    for i in range(len(rows)):
+        row = rows[i]
+        nextrow = rows[i+1] if i+1 < len(rows) else None
         if (len(lat) == len(lon) == 0) and not (np.isnan(row["pt_onseg_lon"]) or np.isnan(row["pt_onseg_lon"])):
             lon.append(row["pt_onseg_lon"])
             lat.append(row["pt_onseg_lat"])
@@ -338,6 +341,8 @@ def _points_summary(cache, gpspoints, pathsegs):
     for col in gpssummary:
         summary["gps_" + col] = gpssummary[col]
     summary["gps__original_index"] = summary["gps__original_index"].astype(int)
+    # times are parsed into datetime64 for speed, but are output as python datetime objects (None if missing)
+    summary["gps__datetime"] = np.asarray(summary["gps__datetime"], dtype="datetime64[s]").astype(object)
 
     waytags = DataFrame.from_dict_list([cache.ways[wayid]["tags"] for wayid in summary["wayid"]], no_value="")
     for tagname in waytags:
@@ -352,7 +357,7 @@ def _segment_summary(cache, gpspoints, pathsegs, nodes):
     for t, d in enumerate(pathsegs):
         mnodes = nodes[t]
         if mnodes is not None and len(mnodes) >= 2:
-            missingsegs = [cache.routing[mnodes[i - 1]][mnodes[i]] for i in range(1, len(mnodes))]
+            missingsegs = [cache.segment(cache.routing[mnodes[i - 1]][mnodes[i]]) for i in range(1, len(mnodes))]
             for seg in missingsegs:
                 seg["points_indicies"] = []
                 allsegs.append(seg)
@@ -429,7 +434,7 @@ def _segment_summary(cache, gpspoints, pathsegs, nodes):
             tripsummary.insert(i+1, *row)
 
         if direction[-1] > 0:
-            nodetags.append(cache.nodes[row["node2"]]["tags"])
+            nodetags.append(cache.node(row["node2"])["tags"])
         elif direction[-1] < 0:
             # switch node 1 and node 2 so that node 1 always comes first
             tripsummary["node1"][i] = row["node2"]
@@ -437,7 +442,7 @@ def _segment_summary(cache, gpspoints, pathsegs, nodes):
             p1 = tuple(row["p1"])
             tripsummary["p1"][i] = row["p2"]
             tripsummary["p2"][i] = p1
-            nodetags.append(cache.nodes[row["node1"]]["tags"])
+            nodetags.append(cache.node(row["node1"])["tags"])
         else:
             nodetags.append({})
 
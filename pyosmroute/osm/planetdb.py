@@ -1,6 +1,35 @@
 
-from ..dbinterface import GenericDB, asdataframe
-from ..geomeasure import sm_project, sm_unproject
+from ..dbinterface import GenericDB, asdataframe, hstore_to_dict
+from ..geomeasure import sm_project
+
+
+# prepared once per connection (see GenericDB.prepared_statements), since these are executed for every GPS point
+# or every batch of ways/nodes added to an OSMCache
+
+# ordering by the <-> operator lets PostGIS walk the GIST index nearest-first instead of sorting, so a LIMIT
+# ($4, NULL for no limit) stops the scan early
+_PREPARE_NEAREST_WAYS = """PREPARE nearest_ways(float8, float8, float8, int8) AS
+    SELECT osm_id, ST_Distance(way, ST_SetSRID(ST_MakePoint($1, $2), 900913)) AS distance
+    FROM planet_osm_line WHERE
+    ST_DWithin(way, ST_SetSRID(ST_MakePoint($1, $2), 900913), $3) AND
+    highway IS NOT NULL AND
+    highway NOT IN ('cycleway', 'footway', 'bridleway', 'steps', 'path')
+    ORDER BY way <-> ST_SetSRID(ST_MakePoint($1, $2), 900913)
+    LIMIT $4"""
+
+_PREPARE_WAYS_RAW = """PREPARE ways_raw(bigint[]) AS
+    SELECT id, nodes, tags from planet_osm_ways WHERE id = ANY($1)"""
+
+# osm2pgsql stores node positions as spherical mercator * 100, unproject them in the same query
+_PREPARE_NODES = """PREPARE nodes(bigint[]) AS
+    SELECT id, ST_Y(pt) AS lat, ST_X(pt) AS lon, tags FROM
+    (SELECT id, tags, ST_Transform(ST_SetSRID(ST_MakePoint(lon/100.0, lat/100.0), 900913), 4326) AS pt
+    FROM planet_osm_nodes WHERE id = ANY($1)) AS nodes"""
+
+
+def _idlist(ids):
+    # psycopg2 adapts a list to an ARRAY, but cannot adapt numpy integer types
+    return [int(id) for id in ids]
 
 
 class PlanetDB(GenericDB):
@@ -9,6 +38,8 @@ class PlanetDB(GenericDB):
     details on creating this database.
     """
 
+    prepared_statements = (_PREPARE_NEAREST_WAYS, _PREPARE_WAYS_RAW, _PREPARE_NODES)
+
     def __init__(self, host, username, password, dbname):
         super(PlanetDB, self).__init__(host, username, password, dbname)
 
@@ -20,20 +51,9 @@ class PlanetDB(GenericDB):
         :param nodeids: A list of node ids.
         :return: A DataFrame with columns id, lon, lat, and tags.
         """
-        arg = " OR ".join("id=%s" % id for id in nodeids)
-        if not arg:
-            arg = "FALSE"
         with self.cursor() as cur:
-            cur.execute("""SELECT id, CAST(lat/100.0 AS FLOAT) as lat, CAST(lon/100.0 AS FLOAT) as lon, tags
-                    FROM planet_osm_nodes WHERE %s""" % arg)
-            out = asdataframe(cur)
-            if len(out) > 0:
-                # convert points to lat/lon
-                newpoints = [sm_unproject((out["lon"][i], out["lat"][i])) for i in range(len(out))]
-                newpoints = list(zip(*newpoints))
-                out["lon"] = newpoints[0]
-                out["lat"] = newpoints[1]
-            return out
+            cur.execute("EXECUTE nodes(%s::bigint[])", (_idlist(nodeids), ))
+            return asdataframe(cur)
 
     def node_way(self, *nodeids):
         """
@@ -42,9 +62,8 @@ class PlanetDB(GenericDB):
         :param nodeids: The node ids
         :return: A DataFrame of the output.
         """
-        arg = ", ".join(str(nodeid) for nodeid in nodeids)
         with self.cursor() as cur:
-            cur.execute("""SELECT * FROM planet_osm_ways where nodes @> ARRAY[%s]::bigint[]""" % arg)
+            cur.execute("""SELECT * FROM planet_osm_ways where nodes @> %s::bigint[]""", (_idlist(nodeids), ))
             return asdataframe(cur)
 
     def ways(self, *wayids):
@@ -55,38 +74,73 @@ class PlanetDB(GenericDB):
         :param wayids: A list of way ids.
         :return: A DataFrame with columns id (int), nodes (list), and tags (dict).
         """
-        arg = " OR ".join("id=%s" % id for id in wayids) if wayids else "FALSE"
         with self.cursor() as cur:
-            cur.execute("""SELECT * from planet_osm_ways WHERE %s""" % arg)
+            cur.execute("""SELECT * from planet_osm_ways WHERE id = ANY(%s::bigint[])""", (_idlist(wayids), ))
             return asdataframe(cur)
 
-    def nearest_ways(self, lon, lat, radius=15):
+    def ways_raw(self, *wayids):
+        """
+        Get information about ways without building a DataFrame, for callers that only iterate over
+        the result.
+
+        :param wayids: A list of way ids.
+        :return: A list of dicts with keys id (int), nodes (list), and tags (dict).
+        """
+        with self.cursor() as cur:
+            cur.execute("EXECUTE ways_raw(%s::bigint[])", (_idlist(wayids), ))
+            return [{"id": wayid, "nodes": nodes, "tags": hstore_to_dict(tags)}
+                    for wayid, nodes, tags in cur.fetchall()]
+
+    def nearest_ways(self, lon, lat, radius=15, limit=None):
         """
         Get a list of the wayids closest to this lon/lat, ordered closest first.
 
         :param lon: The longitude
         :param lat: The latitude
         :param radius: The radius to consider
+        :param limit: The maximum number of wayids to return, or None to return all ways within radius
         :return: A list of wayids
         """
 
-        pt = "%s, %s" % sm_project((lon, lat))
+        x, y = sm_project((lon, lat))
 
         with self.cursor() as cur:
-            cur.execute(
-                """SELECT osm_id, ST_Distance(way, ST_SetSRID(ST_MakePoint(%s), 900913)) as distance
-                FROM planet_osm_line WHERE
-                ST_DWithin(way, ST_SetSRID(ST_MakePoint(%s),900913), %s) AND
-                highway IS NOT NULL
-                AND (highway != 'cycleway'
-                AND highway != 'footway'
-                AND highway != 'bridleway'
-                AND highway != 'steps'
-                AND highway != 'path')
-                ORDER BY ST_Distance(way, ST_SetSRID(ST_MakePoint(%s), 900913))""" %
-                (pt, pt, radius, pt))
+            cur.execute("EXECUTE nearest_ways(%s, %s, %s, %s)", (float(x), float(y), float(radius),
+                                                                 None if limit is None else int(limit)))
             tup = cur.fetchall()
             if tup:  # not using the 'distance' item yet since XTE is calculated later
                 return tuple(zip(*tup))[0]
             else:
                 return ()
+
+    def nearest_ways_batch(self, lons, lats, radius=15, limit=None):
+        """
+        Get the wayids closest to each of several points using a single query.
+
+        :param lons: The longitudes
+        :param lats: The latitudes
+        :param radius: The radius to consider
+        :param limit: The maximum number of wayids to return for each point, or None to return all ways within radius
+        :return: A list with one tuple of wayids (ordered closest first) per point
+        """
+        xs, ys = [], []
+        for lon, lat in zip(lons, lats):
+            x, y = sm_project((lon, lat))
+            xs.append(float(x))
+            ys.append(float(y))
+
+        out = [[] for i in range(len(xs))]
+        with self.cursor() as cur:
+            cur.execute(
+                """WITH pts AS (SELECT ord, ST_SetSRID(ST_MakePoint(x, y), 900913) AS pt
+                FROM unnest(%s::float8[], %s::float8[]) WITH ORDINALITY AS t(x, y, ord))
+                SELECT pts.ord, w.osm_id FROM pts JOIN LATERAL
+                (SELECT osm_id, way <-> pts.pt AS distance FROM planet_osm_line WHERE
+                ST_DWithin(way, pts.pt, %s) AND
+                highway IS NOT NULL AND
+                highway NOT IN ('cycleway', 'footway', 'bridleway', 'steps', 'path')
+                ORDER BY way <-> pts.pt LIMIT %s) AS w ON TRUE
+                ORDER BY pts.ord, w.distance""", (xs, ys, float(radius), None if limit is None else int(limit)))
+            for ord, wayid in cur.fetchall():
+                out[ord - 1].append(wayid)
+        return [tuple(wayids) for wayids in out]
@@ -1,5 +1,4 @@
 import numpy as np
-from .osm import mapmatch
 from .osm.planetdb import PlanetDB
 
 
@@ -26,16 +25,35 @@ def get_planet_db(db_host=None, db_user=None, db_password=None, db_name=None):
 
 def on_road(db, gpsdf, radius=15, latitude_column="Latitude", longitude_column="Longitude"):
     """
-    Calculate a percentage of points within the given radius of an OSM road segment.
+    Test whether each point is within radius of an OSM road.
 
     :param db: A PlanetDB object
     :param gpsdf: A DataFrame with lat/lon information.
     :param radius: The radius within which to consider the point "on a road".
     :param latitude_column: The column identifier referring to the latitude column.
     :param longitude_column: The column identifier referring to the longitude column.
-    :return: A float between 0 and 1.
+    :return: A boolean ndarray, True for each point within radius of a road.
     """
-    res = np.array([mapmatch.nearest_road(db, radius,
-                                          (gpsdf[longitude_column][i], gpsdf[latitude_column][i])) is not None
-                    for i in range(len(gpsdf))])
-    return res
+    lons, lats = gpsdf[longitude_column], gpsdf[latitude_column]
+    # a stationary GPS repeats the same position, so only look up each distinct point once
+    points = {}
+    index = np.array([points.setdefault((lons[i], lats[i]), len(points)) for i in range(len(gpsdf))], dtype=int)
+    # only the presence of a nearby way matters, so fetch at most one for all points in a single query
+    ways = db.nearest_ways_batch([lon for lon, lat in points], [lat for lon, lat in points], radius=radius, limit=1)
+    found = np.fromiter((len(wayids) > 0 for wayids in ways), dtype=bool, count=len(ways))
+    return found[index]
+
+
+def on_road_percent(db, gpsdf, radius=15, latitude_column="Latitude", longitude_column="Longitude"):
+    """
+    Calculate the proportion of points within the given radius of an OSM road segment.
+
+    :param db: A PlanetDB object
+    :param gpsdf: A DataFrame with lat/lon information.
+    :param radius: The radius within which to consider the point "on a road".
+    :param latitude_column: The column identifier referring to the latitude column.
+    :param longitude_column: The column identifier referring to the longitude column.
+    :return: A float between 0 and 1 (nan if there are no points).
+    """
+    res = on_road(db, gpsdf, radius=radius, latitude_column=latitude_column, longitude_column=longitude_column)
+    return float(res.mean()) if len(res) else float("nan")
@@ -1,6 +1,10 @@
 
 import os
+import datetime
+import numpy as np
 import pyosmroute as pyosm
+from pyosmroute import gpsclean
+from pyosmroute.gpsclean import seconds_between
 
 
 def test_match(db):
@@ -26,10 +30,41 @@ def test_clean():
     df = pyosm.cleanpoints(df)
     pyosm.log("got data frame with %s rows" % len(df))
 
+    # time differences: whole seconds, wrapped to within a day, nan if a time is missing
+    t1 = np.datetime64("2016-03-01T20:59:46")
+    assert seconds_between(t1, np.datetime64("2016-03-01T21:00:16")) == 30
+    assert seconds_between(datetime.datetime(2016, 3, 1, 23, 59, 50), datetime.datetime(2016, 3, 2, 0, 0, 10)) == 20
+    assert seconds_between(t1, t1 + np.timedelta64(86400 + 5, "s")) == 5
+    assert np.isnan(seconds_between(t1, np.datetime64("NaT")))
+    assert list(seconds_between(np.array([t1, t1]), np.array([t1 + 1, t1 + 2]))) == [1, 2]
+
+    # compute_motion() gives the same values as the separate functions
+    df["_datetime"] = gpsclean.datetimes(df)
+    dists, vels, bearings, rots = gpsclean.compute_motion(df)
+    assert len(dists) == len(vels) == len(bearings) == len(rots) == len(df)
+    assert np.isnan(dists[0])
+    assert np.allclose(dists[1:], gpsclean.distances(df)[1:])
+    assert np.allclose(vels, gpsclean.velocities(df), equal_nan=True)
+    assert np.allclose(bearings, gpsclean.bearings(df), equal_nan=True)
+    df["_bearing"] = bearings
+    assert np.allclose(rots, gpsclean.rotations(df), equal_nan=True)
+
+    # points without a time are removed
+    times = ["2016-01-01 00:00:00", "2016-01-01 00:00:10", "", "2016-01-01 00:00:30", "2016-01-01 00:00:40"]
+    df = pyosm.DataFrame(times, [-64.0, -64.0001, -64.0002, -64.0003, -64.0004], [45.0] * 5,
+                         columns=["Time", "Longitude", "Latitude"])
+    df = pyosm.cleanpoints(df, min_velocity=None)
+    assert list(df["Time"]) == times[:2] + times[3:]
+
 
 def test_onroad(db):
     df = pyosm.read_csv("example-data/test/2016-03-02 17_37_41_Car - Normal Drive_Android.csv", skiprows=1)
-    pyosm.log(pyosm.on_road_percent(db, df))
+    percent = pyosm.on_road_percent(db, df)
+    pyosm.log(percent)
+    onroad = pyosm.on_road(db, df)
+    assert len(onroad) == len(df) and onroad.dtype == bool
+    assert 0 <= percent <= 1 and percent == onroad.mean()
+    assert np.isnan(pyosm.on_road_percent(db, df.iloc[[], :]))
 
 
 def test_nearest_road(db):
@@ -86,6 +121,37 @@ def test_data_frame():
 
     pyosm.log(b.copy())
 
+    # raw rows are plain tuples
+    a = pyosm.DataFrame([1, 2, 3], ["one", "two", "three"], columns=["num", "name"])
+    assert list(a.itertuples(raw=True)) == [(0, 1, "one"), (1, 2, "two"), (2, 3, "three")]
+    assert list(a.itertuples(rownames=False, raw=True)) == [(1, "one"), (2, "two"), (3, "three")]
+    assert [row["name"] for row in a.itertuples()] == ["one", "two", "three"]
+
+    # copy() is shallow: new columns don't affect the original, but the column arrays are shared
+    c = a.copy()
+    c["extra"] = [0, 0, 0]
+    assert "extra" not in a and list(c.columns()) == ["num", "name", "extra"]
+    assert c["num"] is a["num"]
+
+    # a slice of rows is a view of the original columns, other row subsets are copies
+    c = a.iloc[0:2, :]
+    assert list(c["num"]) == [1, 2] and np.shares_memory(c["num"], a["num"])
+    c = a.iloc[[0, 2], :]
+    assert list(c["name"]) == ["one", "three"] and not np.shares_memory(c["num"], a["num"])
+
+    # usecols keeps columns by index. every row must have all of them
+    with open("fish.csv", "w") as f:
+        f.write("a,b,c\n1,x,1.5\n2,y,2.5\n")
+    c = pyosm.read_csv("fish.csv", usecols=[0, 2])
+    assert list(c.columns()) == ["a", "c"] and list(c["a"]) == [1, 2] and list(c["c"]) == [1.5, 2.5]
+    with open("fish.csv", "a") as f:
+        f.write("3\n")
+    try:
+        pyosm.read_csv("fish.csv", usecols=[0, 2])
+        raise AssertionError("rows shorter than usecols should raise IndexError")
+    except IndexError:
+        pass
+
     os.unlink("fish.tsv")
     os.unlink("fish.csv")
 